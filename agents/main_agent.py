@@ -1,3 +1,4 @@
+import logging
 from agno.agent import Agent
 import re
 from typing import Dict, Any
@@ -7,6 +8,8 @@ from messages import  MESSAGES, get_message
 # Fix: Use package imports
 from tools import SupabaseClient
 
+logger = logging.getLogger(__name__)
+
 class MainAgent:
     """Main agent that handles user management and routes messages to specialized agents"""
 
@@ -52,7 +55,7 @@ class MainAgent:
                 f"The user is speaking {lang_name}. Classify this user message and explain briefly: '{message}'"
             )
             intent_response = str(intent_response_obj.content)
-            print("Intent response main agent:", intent_response)
+            logger.debug("Intent response main agent: %s", intent_response)
             
             # Route based on intent classification
             if self._contains_intent(intent_response, "TRANSACTION"):
@@ -93,7 +96,7 @@ class MainAgent:
                 
         except Exception as e:
             #print("failed to route message")
-            print(f"❌ Main Agent: Error routing message: {e}")
+            logger.error(f"❌ Main Agent: Error routing message: {e}")
             return "❌ Sorry, I encountered an error. Please try rephrasing your request."
 
     def _get_help_content(self, lang: str = 'en') -> str:
@@ -1,3 +1,4 @@
+import logging
 from agno.agent import Agent
 import re
 import json
@@ -9,6 +10,8 @@ from tools import Reminder, ReminderType, Priority, SupabaseClient
 from messages import get_message
 import pytz # <-- 1. Import pytz
 
+logger = logging.getLogger(__name__)
+
 class ReminderAgent:
     """Specialized agent for handling reminders and tasks"""
 
@@ -42,7 +45,7 @@ class ReminderAgent:
             try:
                 user_tz = pytz.timezone(user_timezone)
             except pytz.UnknownTimeZoneError:
-                print(f"⚠️ Unknown timezone '{user_timezone}'. Defaulting to UTC.")
+                logger.warning(f"⚠️ Unknown timezone '{user_timezone}'. Defaulting to UTC.")
                 user_tz = pytz.utc
             
             user_now_iso = datetime.now(user_tz).isoformat()
@@ -61,7 +64,7 @@ class ReminderAgent:
             
             response_obj = await asyncio.to_thread(self.agent.run, extraction_prompt)
             response_str = str(response_obj.content)
-            print(f"🤖 LLM Response: {response_str}")
+            logger.debug(f"🤖 LLM Response: {response_str}")
             try:
                 data = json.loads(response_str)
             except json.JSONDecodeError:
@@ -103,7 +106,7 @@ class ReminderAgent:
             )
             
         except Exception as e:
-            print(f"❌ Error processing reminder message: {e}")
+            logger.error(f"❌ Error processing reminder message: {e}")
             return get_message("reminder_creation_failed", language)
 
     async def get_reminders(self, user_id: str, language: str, user_timezone: str, limit: int = 10) -> str:
@@ -157,7 +160,7 @@ class ReminderAgent:
             return f"{get_message('pending_reminders_header', language)}\n\n{formatted_list}"
             
         except Exception as e:
-            print(f"❌ Error getting reminders: {e}")
+            logger.error(f"❌ Error getting reminders: {e}")
             return get_message("reminder_fetch_failed", language)
     
     async def get_due_soon(self, user_id: str, hours: int = 24) -> str:
@@ -193,7 +196,7 @@ class ReminderAgent:
             return message
             
         except Exception as e:
-            print(f"❌ Error getting due reminders: {e}")
+            logger.error(f"❌ Error getting due reminders: {e}")
             return "❌ Sorry, I couldn't check your due reminders right now."
     
     def _parse_due_date(self, date_str: str) -> Optional[datetime]:
@@ -205,7 +208,7 @@ class ReminderAgent:
             return datetime.fromisoformat(date_str.replace('Z', '+00:00'))
         except (ValueError, TypeError):
             # Basic fallback for non-ISO formats (less reliable)
-            print(f"⚠️ Could not parse date '{date_str}' with ISO format. Fallback may be inaccurate.")
+            logger.warning(f"⚠️ Could not parse date '{date_str}' with ISO format. Fallback may be inaccurate.")
             return None
 
     def _fallback_parse(self, message: str, language: str) -> Dict[str, Any]:
@@ -1,3 +1,4 @@
+import logging
 from agno.agent import Agent
 from agno.models.groq import Groq
 import os
@@ -10,6 +11,8 @@ from timezonefinder import TimezoneFinder
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut, GeocoderUnavailable
 
+logger = logging.getLogger(__name__)
+
 # --- 1. Define the tool as a self-contained function ---
 # It should not have `self` or other external dependencies in its signature.
 # The necessary clients (geolocator, timezonefinder) are created inside.
@@ -35,16 +38,16 @@ def get_iana_timezone(location_name: str) -> str:
             # Find the timezone using the coordinates
             timezone_name = tf.timezone_at(lng=location.longitude, lat=location.latitude)
             if timezone_name:
-                print(f"✅ TimezoneTool: Found '{timezone_name}' for '{location_name}'")
+                logger.info(f"✅ TimezoneTool: Found '{timezone_name}' for '{location_name}'")
                 return timezone_name
         
-        print(f"⚠️ TimezoneTool: Could not find a valid timezone for '{location_name}'")
+        logger.warning(f"⚠️ TimezoneTool: Could not find a valid timezone for '{location_name}'")
         return "INVALID"
     except (GeocoderTimedOut, GeocoderUnavailable):
-        print(f"❌ TimezoneTool: Geocoding service is unavailable.")
+        logger.error(f"❌ TimezoneTool: Geocoding service is unavailable.")
         return "INVALID"
     except Exception as e:
-        print(f"❌ TimezoneTool: An unexpected error occurred: {e}")
+        logger.error(f"❌ TimezoneTool: An unexpected error occurred: {e}")
         return "INVALID"
 
 class TimezoneAgent:
@@ -148,7 +151,7 @@ class TimezoneAgent:
             # --- 3. Use the LLM with the dynamic prompt ---
             response = await asyncio.to_thread(self.agent.run, full_prompt)
             iana_name = response.content.strip()
-            print("✅ TimezoneAgent identified:", iana_name)
+            logger.info("✅ TimezoneAgent identified: %s", iana_name)
             if iana_name == "INVALID" or iana_name not in pytz.all_timezones:
                 return None, None
 
@@ -156,5 +159,5 @@ class TimezoneAgent:
             
             return iana_name, utc_offset
         except Exception as e:
-            print(f"❌ Error in tool-based TimezoneAgent: {e}")
+            logger.error(f"❌ Error in tool-based TimezoneAgent: {e}")
             return None, None
@@ -1,3 +1,4 @@
+import logging
 from agno.agent import Agent
 import re
 import json
@@ -5,9 +6,12 @@ from datetime import datetime, timedelta
 from typing import Dict, Any, Optional
 import asyncio  # <-- 1. IMPORT ASYNCIO
 from agno.models.groq import Groq
+from agno.media import Image, File
 # Fix: Use package imports from __init__.py
 from tools import Transaction, TransactionType, SupabaseClient
 
+logger = logging.getLogger(__name__)
+
 
 class TransactionAgent:
     """Specialized agent for handling financial transactions"""
@@ -151,11 +155,19 @@ class TransactionAgent:
             )
             
         except Exception as e:
-            print(f"❌ Transaction Agent: Error processing transaction message: {e}")
+            logger.error(f"❌ Transaction Agent: Error processing transaction message: {e}")
             return "❌ Sorry, I couldn't process that transaction. Please try again with a clearer format."
 
     async def process_receipt_image(self, user_id: str, image_path: str, lang: str = 'en') -> str:
         """Process receipt image using Gemini vision capabilities"""
+        return await self._process_receipt(user_id, image_path, image_path, lang)
+
+    async def process_receipt_bytes(self, user_id: str, data: bytes, lang: str = 'en') -> str:
+        """Process an in-memory receipt image (no temp file round-trip)"""
+        return await self._process_receipt(user_id, Image(content=data), None, lang)
+
+    async def _process_receipt(self, user_id: str, image: Any, receipt_ref: Optional[str], lang: str = 'en') -> str:
+        """Shared receipt flow for path- and bytes-based images"""
         try:
             # Use Gemini vision to extract receipt data
             extraction_prompt = f"""
@@ -180,7 +192,7 @@ class TransactionAgent:
             response_obj = await asyncio.to_thread(
                 self.vision_agent.run,
                 extraction_prompt,
-                images=[image_path]
+                images=[image]
             )
             response = response_obj.content # <-- FIX: Access the .content attribute
             
@@ -213,7 +225,7 @@ class TransactionAgent:
                 merchant=data.get("merchant"),
                 confidence_score=0.90,
                 tags=["receipt"],
-                receipt_image_url=image_path  # Store the path
+                receipt_image_url=receipt_ref  # Store the path (None for in-memory uploads)
             )
             
             # Save to database
@@ -230,11 +242,19 @@ class TransactionAgent:
             )
             
         except Exception as e:
-            print(f"❌ Transaction (Receipt): Error processing receipt image: {e}")
+            logger.error(f"❌ Transaction (Receipt): Error processing receipt image: {e}")
             return "❌ Sorry, I couldn't process that receipt image. Please try again or enter the transaction manually."
 
     async def process_bank_statement(self, user_id: str, pdf_path: str, lang: str = 'en') -> str:
         """Process bank statement PDF using Gemini"""
+        return await self._process_bank_statement(user_id, pdf_path, lang)
+
+    async def process_bank_statement_bytes(self, user_id: str, data: bytes, lang: str = 'en') -> str:
+        """Process an in-memory bank statement PDF (no temp file round-trip)"""
+        return await self._process_bank_statement(user_id, File(content=data, mime_type="application/pdf"), lang)
+
+    async def _process_bank_statement(self, user_id: str, pdf: Any, lang: str = 'en') -> str:
+        """Shared bank statement flow for path- and bytes-based PDFs"""
         try:
             # Use Gemini to extract multiple transactions from PDF
             extraction_prompt = f"""
@@ -260,7 +280,7 @@ class TransactionAgent:
             response_obj = await asyncio.to_thread(
                 self.vision_agent.run,
                 extraction_prompt,
-                files=[pdf_path]
+                files=[pdf]
             )
             response = response_obj.content # <-- FIX: Access the .content attribute
             
@@ -310,7 +330,7 @@ class TransactionAgent:
                     await self.supabase_client.database.save_transaction(transaction)
                     saved_count += 1
                 except Exception as e:
-                    print(f"❌ Error saving transaction: {e}")
+                    logger.error(f"❌ Error saving transaction: {e}")
                     continue
             
             return (
@@ -322,7 +342,7 @@ class TransactionAgent:
             )
             
         except Exception as e:
-            print(f"❌ Transaction (Bank Statement): Error processing bank statement: {e}")
+            logger.error(f"❌ Transaction (Bank Statement): Error processing bank statement: {e}")
             return "❌ Sorry, I couldn't process that bank statement. Please ensure it's a valid PDF with transaction data."
     
     #TODO adapt to respond in user's language
@@ -372,7 +392,7 @@ class TransactionAgent:
             return message
             
         except Exception as e:
-            print(f"❌ Error generating summary: {e}")
+            logger.error(f"❌ Error generating summary: {e}")
             return "❌ Sorry, I couldn't generate your financial summary right now. Please try again later."
     
     def _validate_category(self, category: str, transaction_type: str) -> str:
@@ -1,14 +1,27 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, BackgroundTasks, Request
-from fastapi.responses import JSONResponse, HTMLResponse, FileResponse
+from fastapi import FastAPI, HTTPException, File, Form, UploadFile, BackgroundTasks, Request, Response, Depends
+from fastapi.responses import HTMLResponse, FileResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles # <-- 1. Import StaticFiles
 from fastapi.templating import Jinja2Templates # <-- 2. Import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.exceptions import HTTPException as StarletteHTTPException
 
-from typing import Optional, List, Dict, Any, Tuple
+from typing import Optional, List, Dict, Any, Tuple, Callable, Awaitable, Annotated, Mapping
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-import uvicorn
+from functools import lru_cache
 import os
+import sys
+import asyncio
+import hashlib
+import logging
+import random
 import tempfile
+import time
+import weakref
+import orjson
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -19,8 +32,6 @@ from messages import MESSAGES, get_message
 # Import models
 from models import (
     MessageRequest,
-    TransactionResponse,
-    ReminderResponse,
     SummaryRequest,
     StartRequest,
     UserCheckRequest,
@@ -32,13 +43,19 @@ from models import (
 # Load environment
 load_dotenv()
 
+from log_config import setup_logging, shutdown_logging
+setup_logging()
+logger = logging.getLogger("api")
+
 # Import existing components
 from tools.supabase_tools import SupabaseClient
 from agents.transaction_agent import TransactionAgent
 from agents.reminder_agent import ReminderAgent
 from agents.main_agent import MainAgent
 from agents.timezone_agent import TimezoneAgent # <-- 2. Import the new agent
-from tools.session_manager import SessionManager
+from tools.session_manager import SessionManager, RedisSessionManager
+from tools.ttl_cache import TTLCache
+from tools.currency_map import build_timezone_currency_map
 
 # Global services (initialized in lifespan)
 supabase_client = None
@@ -47,15 +64,67 @@ reminder_agent = None
 main_agent = None
 timezone_agent = None # <-- 3. Add timezone_agent to globals
 session_manager = None
+services_ready = False  # Flipped by lifespan once every service above is initialised
+
+# Snapshot of which services are up, only recomputed when lifespan changes them
+_SERVICE_STATUS: Dict[str, bool] = {}
+# Prebuilt /health body, regenerated at most once per second (monotonic time, bytes)
+_HEALTH_CACHE: Tuple[float, bytes] = (0.0, b"")
+
+
+def _refresh_service_status() -> None:
+    """Recompute the service snapshot reported by /health and prebuild its body."""
+    global _SERVICE_STATUS, _HEALTH_CACHE
+    _SERVICE_STATUS = {
+        "supabase_client": supabase_client is not None,
+        "transaction_agent": transaction_agent is not None,
+        "reminder_agent": reminder_agent is not None,
+        "main_agent": main_agent is not None
+    }
+    _HEALTH_CACHE = (time.monotonic(), _build_health_body())
+
+
+def _build_health_body() -> bytes:
+    return orjson.dumps({
+        "status": "healthy",
+        "service": "okanassist-ai",
+        "timestamp": datetime.now(),  # orjson encodes datetimes natively (ISO 8601)
+        "services": _SERVICE_STATUS
+    })
+
+# Cap in-flight LLM / document agent calls so bursts get a fast 503 instead of piling up
+AGENT_CONCURRENCY = int(os.getenv("AGENT_CONCURRENCY", "16"))
+AGENT_TIMEOUT_SECONDS = float(os.getenv("AGENT_TIMEOUT_SECONDS", "60"))
+AGENT_SEM = asyncio.Semaphore(AGENT_CONCURRENCY)
+
+# Store link shown after registration / email confirmation
+APP_DOWNLOAD_URL = os.getenv("APP_DOWNLOAD_URL", "https://play.google.com/store/apps/details?id=com.okanassist")
+
+# Uploads are read in fixed-size chunks, kept in memory up to IN_MEMORY_UPLOAD_BYTES,
+# spilled to a temp file beyond that and rejected past MAX_UPLOAD_BYTES
+UPLOAD_CHUNK_SIZE = 1 << 16
+IN_MEMORY_UPLOAD_BYTES = int(os.getenv("IN_MEMORY_UPLOAD_BYTES", 8 * 1024 * 1024))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+
+# Premium/credit fields kept in a session are re-read from the DB at most this often;
+# credit use, refunds and payments update or drop them sooner
+STATUS_TTL_SECONDS = float(os.getenv("STATUS_TTL_SECONDS", "30"))
+
+# Threads behind asyncio.to_thread (Supabase/Stripe SDK calls, upload disk I/O, agents'
+# blocking work, timed-out agent calls still finishing); asyncio's default is min(32, cpu+4)
+THREADPOOL_TOKENS = int(os.getenv("THREADPOOL_TOKENS", "100"))
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage application lifespan - startup and shutdown"""
-    global supabase_client, transaction_agent, reminder_agent, main_agent, timezone_agent, session_manager
+    global supabase_client, transaction_agent, reminder_agent, main_agent, timezone_agent, session_manager, services_ready
     
     # Startup
     try:
-        print("🚀 Starting API services...")
+        logger.info("🚀 Starting API services...")
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=THREADPOOL_TOKENS, thread_name_prefix="api-worker")
+        )
         
         # Initialize Supabase client
         supabase_url = os.getenv('SUPABASE_URL')
@@ -64,6 +133,7 @@ async def lifespan(app: FastAPI):
         if not supabase_url or not supabase_key:
             raise ValueError("SUPABASE_URL and SUPABASE_SECRET_KEY are required")
         
+        # SupabaseClient owns one pooled (HTTP/2 when available) client for all SDK calls
         supabase_client = SupabaseClient(supabase_url, supabase_key)
         await supabase_client.connect()
         
@@ -73,52 +143,135 @@ async def lifespan(app: FastAPI):
         main_agent = MainAgent(supabase_client)
         timezone_agent = TimezoneAgent() # <-- 4. Initialize the timezone agent
         
-        # Initialize session manager
-        session_manager = SessionManager(session_timeout_minutes=30)
+        # Initialize session manager - Redis when configured so all workers share sessions
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url:
+            session_manager = RedisSessionManager(redis_url, session_timeout_minutes=30)
+            logger.info("✅ Using Redis session store")
+        else:
+            session_manager = SessionManager(session_timeout_minutes=30)
+        
+        # Compile the landing page now so the first visitor doesn't pay for it
+        templates.get_template("index.html")
         
-        print("✅ API services initialized successfully")
+        _refresh_service_status()
+        services_ready = True
+        logger.info("✅ API services initialized successfully")
         
         # Yield control to the application
         yield
         
     except Exception as e:
-        print(f"❌ Error initializing API services: {e}")
+        logger.error(f"❌ Error initializing API services: {e}")
         raise
     
     finally:
         # Shutdown
-        print("🛑 Shutting down API services...")
+        services_ready = False
+        logger.info("🛑 Shutting down API services...")
+        
+        if session_manager:
+            try:
+                await session_manager.close()
+            except Exception as e:
+                logger.error(f"❌ Error closing session store: {e}")
         
         if supabase_client:
             try:
                 await supabase_client.disconnect()
-                print("✅ Database disconnected")
+                logger.info("✅ Database disconnected")
             except Exception as e:
-                print(f"❌ Error disconnecting database: {e}")
+                logger.error(f"❌ Error disconnecting database: {e}")
         
-        print("🛑 API services stopped")
+        logger.info("🛑 API services stopped")
+        shutdown_logging()
+
+async def require_ready() -> None:
+    """Dependency guard: reject requests with 503 until lifespan startup has completed."""
+    if not services_ready:
+        raise HTTPException(status_code=503, detail="Service not ready")
 
 # Create FastAPI app
 app = FastAPI(
     title="OkanFit Assist AI API",
     description="Financial AI processing service",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse  # orjson encodes straight to bytes
 )
 
 # --- 3. Mount the static directory and configure templates ---
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
+# Templates only change on deploy - skip the per-render mtime check outside dev
+templates.env.auto_reload = os.getenv("ENV") == "dev"
+# Share compiled template bytecode across worker processes and restarts
+# (JINJA_CACHE_DIR, defaults to a per-user directory under the system temp dir)
+templates.env.bytecode_cache = FileSystemBytecodeCache(os.getenv("JINJA_CACHE_DIR"))
+
+
+@lru_cache(maxsize=256)
+def _error_body(detail: str) -> bytes:
+    """Serialized {"detail": ...} body, memoized for the small set of repeated error messages."""
+    return orjson.dumps({"detail": detail})
+
+
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request: Request, exc: StarletteHTTPException) -> Response:
+    """Return error bodies from a pre-serialized cache instead of re-encoding them per request."""
+    if exc.status_code in (204, 304):
+        return Response(status_code=exc.status_code, headers=exc.headers)
+    if isinstance(exc.detail, str):
+        body = _error_body(exc.detail)
+    else:
+        body = orjson.dumps({"detail": exc.detail})
+    return Response(content=body, status_code=exc.status_code, headers=exc.headers, media_type="application/json")
+
+
+# CORS is only needed for browser clients - the Telegram bot calls the API server-to-server,
+# so the middleware is installed only when CORS_ALLOW_ORIGINS (comma-separated) is set
+CORS_ALLOW_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("CORS_ALLOW_ORIGINS", "").split(",")
+    if origin.strip()
+]
+
+if CORS_ALLOW_ORIGINS:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=CORS_ALLOW_ORIGINS,
+        # Credentials can't be combined with a wildcard origin
+        allow_credentials="*" not in CORS_ALLOW_ORIGINS,
+        allow_methods=["GET", "POST"],
+        allow_headers=["authorization", "content-type"],
+        max_age=86400,  # let browsers cache preflight responses for a day
+    )
 
+# Compress the larger markdown/HTML message bodies (help, summaries, landing page)
+app.add_middleware(GZipMiddleware, minimum_size=512)
 
-# Add CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Opt-in sampling profiler (PROFILE=1) to find the real hot path per route.
+# Requires pyinstrument; off by default so production pays nothing.
+if os.getenv("PROFILE"):
+    from pyinstrument import Profiler
+
+    PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.05"))
+
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next):
+        if random.random() >= PROFILE_SAMPLE_RATE:
+            return await call_next(request)
+
+        profiler = Profiler(interval=0.001, async_mode="enabled")
+        profiler.start()
+        try:
+            return await call_next(request)
+        finally:
+            profiler.stop()
+            logger.info(
+                f"📈 Profile for {request.method} {request.url.path}:\n"
+                f"{profiler.output_text(unicode=True, color=False)}"
+            )
 
 # --- 4. Create the root endpoint to serve the website ---
 @app.get("/", response_class=HTMLResponse)
@@ -126,14 +279,24 @@ async def read_root(request: Request):
     """Serves the main landing page."""
     return templates.TemplateResponse("index.html", {"request": request})
 
+# Static HTML pages are encoded once at import and served as-is
+_PRIVACY_PAGE = b"<h1>Privacy Policy</h1><p>Details coming soon.</p>"
+_TERMS_PAGE = b"<h1>Terms of Service</h1><p>Details coming soon.</p>"
+_CONFIRMATION_PAGE = get_message(
+    "registration_html_success", "en",
+    # Use the URL from the new static files mount
+    logo_url="/static/images/okan_assist_upscale.png",
+    download_url=APP_DOWNLOAD_URL
+).encode()
+
 # You can add placeholder pages for privacy and terms to satisfy Stripe
 @app.get("/privacy", response_class=HTMLResponse)
 async def privacy_policy(request: Request):
-    return "<h1>Privacy Policy</h1><p>Details coming soon.</p>"
+    return HTMLResponse(content=_PRIVACY_PAGE)
 
 @app.get("/terms", response_class=HTMLResponse)
 async def terms_of_service(request: Request):
-    return "<h1>Terms of Service</h1><p>Details coming soon.</p>"
+    return HTMLResponse(content=_TERMS_PAGE)
 
 
 # API Endpoints
@@ -143,25 +306,14 @@ async def handle_email_confirmation():
     Serves a simple HTML page for when a user successfully confirms their email.
     This URL should be set as the confirmation redirect in Supabase Auth settings.
     """
-    # Use the URL from the new static files mount
-    logo_url = "/static/images/okan_assist_upscale.png" 
-    download_url = os.getenv("APP_DOWNLOAD_URL", "https://play.google.com/store/apps/details?id=com.okanassist")
-
-    html_content = MESSAGES["en"]["registration_html_success"].format(
-        logo_url=logo_url,
-        download_url=download_url
-    )
-    return HTMLResponse(content=html_content)
+    return HTMLResponse(content=_CONFIRMATION_PAGE)
 
 
-@app.post("/api/v1/start")
+@app.post("/api/v1/start", dependencies=[Depends(require_ready)])
 async def handle_start(request: StartRequest):
     """Handle /start command with authentication handling"""
     lang = request.language_code
     try:
-        if not main_agent:
-            raise HTTPException(status_code=503, detail="Service not ready")
-        
         # Use centralized authentication
         auth_request = AuthCheckRequest(
             telegram_id=request.user_id,
@@ -184,30 +336,35 @@ async def handle_start(request: StartRequest):
     except HTTPException as e:
         # Check if this is the specific "must register" exception
         # For any other authentication or server error, return a failure
-        print(f"HTTPException in handle_start{e.detail}")
+        logger.info(f"HTTPException in handle_start: {e.detail}")
         return {
             "success": True, # The operation was successful in identifying the user state
             "message": get_message("welcome_unauthenticated", lang)
         }
     except Exception as e:
-        print(f"❌ Unhandled Exception in handle_start: {e}")
+        logger.error(f"❌ Unhandled Exception in handle_start: {e}")
         raise HTTPException(status_code=500, detail="An internal server error occurred.")
 
+# /help is static per language - serialize each body once at import
+_HELP_BODIES: Dict[str, bytes] = {
+    lang: orjson.dumps({"success": True, "message": get_message("help_message", lang)})
+    for lang in MESSAGES
+}
+
 @app.get("/api/v1/help")
 async def handle_help(language_code: Optional[str] = 'en'):
     """Handle /help command - No authentication required"""
-    try:
-        # Help is available to everyone, no authentication needed
-        return {"success": True, "message": get_message("help_message", language_code)}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # Help is available to everyone, no authentication needed
+    lang_short = language_code.split('-')[0] if language_code else 'en'
+    body = _HELP_BODIES.get(lang_short, _HELP_BODIES['en'])
+    return Response(content=body, media_type="application/json")
 
-@app.post("/api/v1/upgrade")
+@app.post("/api/v1/upgrade", dependencies=[Depends(require_ready)])
 async def handle_upgrade(request: UpgradeRequest):
     """Handles the premium upgrade request and generates a payment link."""
     try:
         # 1. Authenticate the user and get their data
-        auth_request = AuthCheckRequest(telegram_id=request.user_id)
+        auth_request = AuthCheckRequest.model_construct(telegram_id=request.user_id)
         user_data = await get_user_data(auth_request)
 
         # 2. Check if the user is already premium
@@ -238,17 +395,14 @@ async def handle_upgrade(request: UpgradeRequest):
         # For other HTTP exceptions, return a structured error
         return {"success": False, "message": e.detail}
     except Exception as e:
-        print(f"❌ Error in handle_upgrade: {e}")
+        logger.error(f"❌ Error in handle_upgrade: {e}")
         raise HTTPException(status_code=500, detail="An internal error occurred while processing your upgrade request.")
 
 
 # stripe listen --forward-to http://localhost:8000/api/v1/webhooks/stripe
-@app.post("/api/v1/webhooks/stripe")
-async def handle_stripe_webhook(request: Request):
+@app.post("/api/v1/webhooks/stripe", dependencies=[Depends(require_ready)])
+async def handle_stripe_webhook(request: Request, background_tasks: BackgroundTasks):
     """Handles incoming webhooks from Stripe to confirm payments."""
-    if not supabase_client:
-        raise HTTPException(status_code=503, detail="Service not ready")
-
     payload = await request.body()
     sig_header = request.headers.get('stripe-signature')
 
@@ -261,163 +415,156 @@ async def handle_stripe_webhook(request: Request):
         # ^^^ Modify handle_stripe_webhook to return (success, telegram_id) or None
 
         if success and telegram_id:
-            # Refresh session for the user
-            user_data = await supabase_client.get_user_by_telegram_id_auth(telegram_id)
-            if user_data:
-                session_manager.create_session(telegram_id, user_data)
-                print(f"✅ Session refreshed for user {telegram_id} after payment.")
+            # Drop the stale session now; rebuild it after Stripe has its 200
+            invalidate_cached_user(telegram_id)
+            await session_manager.invalidate_session(telegram_id)
+            background_tasks.add_task(_refresh_session_after_payment, telegram_id)
 
-            return JSONResponse(content={"status": "success"}, status_code=200)
+            return ORJSONResponse(content={"status": "success"}, status_code=200)
         elif success:
             # No telegram_id found, but processed
-            return JSONResponse(content={"status": "success"}, status_code=200)
+            return ORJSONResponse(content={"status": "success"}, status_code=200)
         else:
-            return JSONResponse(content={"status": "failed"}, status_code=400)
+            return ORJSONResponse(content={"status": "failed"}, status_code=400)
+
+    except Exception as e:
+        logger.error(f"❌ Error processing Stripe webhook: {e}")
+        return ORJSONResponse(content={"status": "error"}, status_code=500)
+
 
+async def _refresh_session_after_payment(telegram_id: str) -> None:
+    """Background task: reload user data and recreate the session after a payment."""
+    try:
+        user_data = await supabase_client.get_user_by_telegram_id_auth(telegram_id)
+        if user_data and _is_user_data_complete(user_data):
+            await session_manager.create_session(telegram_id, user_data)
+            logger.info(f"✅ Session refreshed for user {telegram_id} after payment.")
     except Exception as e:
-        print(f"❌ Error processing Stripe webhook: {e}")
-        return JSONResponse(content={"status": "error"}, status_code=500)
+        logger.error(f"❌ Error refreshing session for {telegram_id} after payment: {e}")
 
 
-@app.post("/api/v1/route-message")
+@app.post("/api/v1/route-message", dependencies=[Depends(require_ready)])
 async def route_message(request: MessageRequest):
     """Route message through main agent - REQUIRES AUTHENTICATION + CREDITS"""
     lang = request.language_code
     try:
-        if not main_agent:
-            raise HTTPException(status_code=503, detail="Service not ready")
-        
         # Step 1: Get user data using centralized helper
-        user_data = await get_user_data(AuthCheckRequest(telegram_id=request.user_id))
+        user_data = await get_user_data(AuthCheckRequest.model_construct(telegram_id=request.user_id))
         supabase_id = user_data.get('user_id', None)
         telegram_id = request.user_id
-        print("user_data:", user_data)
-        # Step 2: Consume credits (since auth is now verified)
-        credit_result = await check_and_consume_credits(supabase_id, 'text_message', 1, user_data)
-        print("credit_result:", credit_result)
-        user_data.setdefault('language', lang)  # Ensure language is set in user_data
-        # Step 3: Process the message
-        if credit_result["success"]:
-            result = await main_agent.route_message(supabase_id, request.message, user_data)
-            # Add credit info to response if not premium
-            if not credit_result.get('is_premium', False):
-                credits_remaining = credit_result.get('credits_remaining', 0)
-                result += get_message("credit_warning", lang, credits_remaining=credits_remaining)
-                if credits_remaining <= 1:
-                    result += get_message("credit_low", lang)
-
-            return {"success": True, "message": result}
-        else:
-           
-            return {"success": False, "message": credit_result.get("message")}
+        logger.debug("user_data: %s", user_data)
+        # One agent run at a time per user: bursts of messages are handled in order instead
+        # of racing each other over the same user context. Queue on the user lock, then
+        # reserve an agent slot, and only then charge - so waiting or a busy 503 costs nothing
+        async with _user_agent_lock(supabase_id), agent_slot() as agent:
+            # Step 2: Consume credits (since auth is now verified)
+            credit_result = await check_and_consume_credits(supabase_id, 'text_message', 1, user_data)
+            logger.debug("credit_result: %s", credit_result)
+            user_data.setdefault('language', lang)  # Ensure language is set in user_data
+            # Step 3: Process the message
+            if credit_result["success"]:
+                async with refund_on_failure(user_data, credit_result, agent):
+                    result = await agent.run(main_agent.route_message, supabase_id, request.message, user_data)
+                # Add credit info to response if not premium
+                if not credit_result.get('is_premium', False):
+                    result += _credit_suffix(lang, credit_result.get('credits_remaining', 0))
+
+                return ORJSONResponse({"success": True, "message": result})
+            else:
+               
+                return ORJSONResponse({"success": False, "message": credit_result.get("message")})
         
     except HTTPException:
         # ✅ Re-raise HTTPExceptions (401, 402, 503, etc.) without modification
         raise
     except Exception as e:
         # ❌ Only catch non-HTTP exceptions
-        print(f"❌ Unexpected error in route_message: {e}")
+        logger.error(f"❌ Unexpected error in route_message: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 ####### Transactions Endpoints
 
-@app.post("/api/v1/process-receipt")
-async def process_receipt(user_id: str, file: UploadFile = File(...)):
+@app.post("/api/v1/process-receipt", dependencies=[Depends(require_ready)])
+async def process_receipt(
+    user_id: Annotated[str, Form()],
+    file: Annotated[UploadFile, File()],
+    background_tasks: BackgroundTasks
+):
     """Process receipt image - REQUIRES AUTHENTICATION + CREDITS"""
     try:
-        if not transaction_agent:
-            raise HTTPException(status_code=503, detail="Service not ready")
-        
         # Step 1: Get user data using centralized helper
-        user_data = await get_user_data(AuthCheckRequest(telegram_id=user_id))
+        user_data = await get_user_data(AuthCheckRequest.model_construct(telegram_id=user_id))
         supabase_id = user_data.get('user_id', None)
         lang_code = user_data.get('language', 'en')
-        # Step 2: Consume credits (since auth is now verified)
-        credit_result = await check_and_consume_credits(supabase_id, 'receipt_processing', 5, user_data)
-
-        # Step 3: Process the receipt
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_file:
-            content = await file.read()
-            temp_file.write(content)
-            temp_path = temp_file.name
-
-        result = await transaction_agent.process_receipt_image(supabase_id, temp_path)
-
-        # Clean up temp file
-        os.unlink(temp_path)
+        # Reserve an agent slot before charging, so a busy server answers 503 for free
+        async with agent_slot() as agent:
+            # Step 2: Consume credits (since auth is now verified)
+            credit_result = await check_and_consume_credits(supabase_id, 'receipt_processing', 5, user_data)
+            if not credit_result["success"]:
+                return ORJSONResponse({"success": False, "message": credit_result.get("message")})
+
+            # Step 3: Process the receipt
+            # Small uploads are handed to the agent in memory, large ones via a temp file
+            async with refund_on_failure(user_data, credit_result, agent):
+                result = await _process_upload(
+                    agent, file, ".jpg", background_tasks,
+                    transaction_agent.process_receipt_bytes, transaction_agent.process_receipt_image, supabase_id
+                )
         
         # Add credit info to response if not premium
         if not credit_result.get('is_premium', False):
-            credits_remaining = credit_result.get('credits_remaining', 0)
-            result += get_message("credits_remaining", lang_code, credits_remaining=credits_remaining)##MESSAGES["credits_remaining"].format(credits_remaining=credits_remaining)
+            result += _credit_suffix(lang_code, credit_result.get('credits_remaining', 0), low_warning=False)
         
-        return TransactionResponse(success=True, message=result)
+        return ORJSONResponse({"success": True, "message": result})
         
     except HTTPException:
         # ✅ Re-raise HTTPExceptions (401, 402, 503, etc.)
         raise
     except Exception as e:
-        # Clean up temp file on error
-        if 'temp_path' in locals():
-            try:
-                os.unlink(temp_path)
-            except:
-                pass
-        print(f"❌ Unexpected error in process_receipt: {e}")
+        logger.error(f"❌ Unexpected error in process_receipt: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
-@app.post("/api/v1/process-bank-statement")
-async def process_bank_statement(user_id: str, file: UploadFile = File(...)):
+@app.post("/api/v1/process-bank-statement", dependencies=[Depends(require_ready)])
+async def process_bank_statement(
+    user_id: Annotated[str, Form()],
+    file: Annotated[UploadFile, File()],
+    background_tasks: BackgroundTasks
+):
     """Process bank statement PDF - REQUIRES AUTHENTICATION"""
     try:
-        if not transaction_agent:
-            raise HTTPException(status_code=503, detail="Service not ready")
-        
         # Step 1: Get user data using centralized helper
-        user_data = await get_user_data(AuthCheckRequest(telegram_id=user_id))
+        user_data = await get_user_data(AuthCheckRequest.model_construct(telegram_id=user_id))
         supabase_id = user_data.get('user_id', None)
-        # Step 2: Consume credits (since auth is now verified) - Note: 0 credits for bank statement
-        credit_result = await check_and_consume_credits(supabase_id, 'bank_statement', 0, user_data)
-
-        # Step 3: Process the bank statement
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-            content = await file.read()
-            temp_file.write(content)
-            temp_path = temp_file.name
-
-        result = await transaction_agent.process_bank_statement(supabase_id, temp_path)
-
-        # Clean up temp file
-        os.unlink(temp_path)
+        # Reserve an agent slot before charging, so a busy server answers 503 for free
+        async with agent_slot() as agent:
+            # Step 2: Consume credits (since auth is now verified) - Note: 0 credits for bank statement
+            credit_result = await check_and_consume_credits(supabase_id, 'bank_statement', 0, user_data)
+
+            # Step 3: Process the bank statement
+            # Small uploads are handed to the agent in memory, large ones via a temp file
+            async with refund_on_failure(user_data, credit_result, agent):
+                result = await _process_upload(
+                    agent, file, ".pdf", background_tasks,
+                    transaction_agent.process_bank_statement_bytes, transaction_agent.process_bank_statement, supabase_id
+                )
         
-        return TransactionResponse(success=True, message=result)
+        return ORJSONResponse({"success": True, "message": result})
         
     except HTTPException:
         # ✅ Re-raise HTTPExceptions (401, 503, etc.)
         raise
     except Exception as e:
-        # Clean up temp file on error
-        if 'temp_path' in locals():
-            try:
-                os.unlink(temp_path)
-            except:
-                pass
-        print(f"❌ Unexpected error in process_bank_statement: {e}")
+        logger.error(f"❌ Unexpected error in process_bank_statement: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
 
-@app.post("/api/v1/get-transaction-summary")
+@app.post("/api/v1/get-transaction-summary", dependencies=[Depends(require_ready)])
 async def get_transaction_summary(request: SummaryRequest):
     """Get transaction summary - REQUIRES AUTHENTICATION"""
     try:
-        if not transaction_agent:
-            raise HTTPException(status_code=503, detail="Service not ready")
-        
         # Step 1: Get user data using centralized helper
-        user_data = await get_user_data(AuthCheckRequest(telegram_id=request.user_id))
+        user_data = await get_user_data(AuthCheckRequest.model_construct(telegram_id=request.user_id))
         supabase_id = user_data.get('user_id', None)
         # Step 2: Process the summary (no credits needed)
         result = await transaction_agent.get_summary(supabase_id, request.days)
@@ -426,18 +573,15 @@ async def get_transaction_summary(request: SummaryRequest):
         # ✅ Re-raise HTTPExceptions (401, 503, etc.)
         raise
     except Exception as e:
-        print(f"❌ Unexpected error in get_transaction_summary: {e}")
+        logger.error(f"❌ Unexpected error in get_transaction_summary: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
-@app.post("/api/v1/get-reminders")
+@app.post("/api/v1/get-reminders", dependencies=[Depends(require_ready)])
 async def get_reminders(user_id: str, limit: int = 10):
     """Get user reminders - REQUIRES AUTHENTICATION"""
     try:
-        if not reminder_agent:
-            raise HTTPException(status_code=503, detail="Service not ready")
-        
         # Step 1: Get user data using centralized helper
-        user_data = await get_user_data(AuthCheckRequest(telegram_id=user_id))
+        user_data = await get_user_data(AuthCheckRequest.model_construct(telegram_id=user_id))
         supabase_id = user_data.get('user_id', None)
         # Step 2: Process the reminders (no credits needed)
         result = await reminder_agent.get_reminders(supabase_id, limit)
@@ -446,47 +590,46 @@ async def get_reminders(user_id: str, limit: int = 10):
         # ✅ Re-raise HTTPExceptions (401, 503, etc.)
         raise
     except Exception as e:
-        print(f"❌ Unexpected error in get_reminders: {e}")
+        logger.error(f"❌ Unexpected error in get_reminders: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 #TODO improve for currency 
-@app.post("/api/v1/register")
+@app.post("/api/v1/register", dependencies=[Depends(require_ready)])
 async def register_user(request: RegisterRequest):
     """Register new user using Supabase Auth"""
     lang_code = request.language_code
     try:
-        if not supabase_client or not timezone_agent:
-            raise HTTPException(status_code=503, detail="Service not ready")
-        
-        # Try to check if the user is already registered/authenticated
-        user_data = None
+        # Start identifying the timezone while checking whether the user is already
+        # registered; it is a paid LLM call plus a geocode, so it is cancelled as soon
+        # as it turns out not to be needed
+        raw_timezone_input = request.timezone
+        timezone_task = asyncio.ensure_future(timezone_agent.identify_timezone(
+            language=lang_code, 
+            text_input=raw_timezone_input
+        ))
         try:
-            user_data = await get_user_data(AuthCheckRequest(telegram_id=request.telegram_id))
-        except HTTPException as e:
-            # Only continue registration if user not found (401 or 404)
-            if e.status_code not in (401, 404):
-                raise  # Re-raise other errors (service unavailable, etc.)
-            user_data = None  # Explicitly set to None for clarity
+            user_data = await _get_registered_user_data(request.telegram_id)
+        except BaseException:
+            timezone_task.cancel()
+            raise
 
         if user_data:
+            timezone_task.cancel()
             return {
                 "success": False, 
                 "message": get_message("already_registered", lang_code)
             }
+
+        processed_timezone, utc_offset = await timezone_task
         
         # --- Registration process continues here ---
-        raw_timezone_input = request.timezone
-        processed_timezone, utc_offset = await timezone_agent.identify_timezone(
-            language=lang_code, 
-            text_input=raw_timezone_input
-        )
-        print(f"Processed timezone: {processed_timezone}, UTC offset: {utc_offset}")
+        logger.info(f"Processed timezone: {processed_timezone}, UTC offset: {utc_offset}")
 
         if not processed_timezone:
-            print(f"⚠️ Timezone identification failed for input '{raw_timezone_input}'. Defaulting to UTC.")
+            logger.warning(f"⚠️ Timezone identification failed for input '{raw_timezone_input}'. Defaulting to UTC.")
             processed_timezone = "UTC"
         inferred_currency = infer_currency(processed_timezone)
-        print(f"Inferred currency: {inferred_currency}")
+        logger.info(f"Inferred currency: {inferred_currency}")
         
         # Create new user in Supabase Auth
         auth_result = await supabase_client.sign_up_user_with_auth(
@@ -531,10 +674,11 @@ async def register_user(request: RegisterRequest):
                 'telegram_id': request.telegram_id,
                 'authenticated': True
             }
-            session_manager.create_session(request.telegram_id, user_data)
+            invalidate_cached_user(request.telegram_id)
+            await session_manager.create_session(request.telegram_id, user_data)
             return {
                 "success": True,
-                "message": get_message("registration_success", lang_code, name=request.name, password=auth_result['password'], download_url=os.getenv("APP_DOWNLOAD_URL", "https://play.google.com/store/apps/details?id=com.okanassist")),
+                "message": get_message("registration_success", lang_code, name=request.name, password=auth_result['password'], download_url=APP_DOWNLOAD_URL),
                 "user_data": user_data
             }
         else:
@@ -545,45 +689,53 @@ async def register_user(request: RegisterRequest):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Registration error API register_user: error aqui {e}")
+        logger.error(f"❌ Registration error API register_user: error aqui {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 ##### Others endpoints
 
-@app.get("/api/v1/profile")
-async def get_profile(user_id: str):
+@app.get("/api/v1/profile", dependencies=[Depends(require_ready)])
+async def get_profile(user_id: str, request: Request):
     """Get user profile - REQUIRES AUTHENTICATION"""
     try:
         # Step 1: Get user data using centralized helper
-        user_data = await get_user_data(AuthCheckRequest(telegram_id=user_id))
+        user_data = await get_user_data(AuthCheckRequest.model_construct(telegram_id=user_id))
         
         # --- FIX: Return the raw user_data dictionary ---
         # The bot handler will be responsible for formatting.
-        return {"success": True, "user_data": user_data}
+        # last_activity is session bookkeeping that changes on every call - leave it
+        # out so the ETag only changes when the profile itself does
+        # Premium and credit state can change at any time, so that slice of the session
+        # has its own short expiry; the rest of the profile is served as cached
+        if time.time() - user_data.get('status_refreshed_at', 0) > STATUS_TTL_SECONDS:
+            await _refresh_session_status(user_id, user_data)
+        profile = {
+            key: value for key, value in user_data.items()
+            if key not in ('last_activity', 'status_refreshed_at')
+        }
+        body = orjson.dumps({"success": True, "user_data": profile}, option=orjson.OPT_SORT_KEYS)
+        etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
 
     except HTTPException:
         # ✅ Re-raise HTTPExceptions (401, 503, etc.)
         raise
     except Exception as e:
-        print(f"❌ Unexpected error in get_profile: {e}")
+        logger.error(f"❌ Unexpected error in get_profile: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
 @app.get("/api/v1/health")
 async def health_check():
     """Health check endpoint"""
-    return {
-        "status": "healthy", 
-        "service": "okanassist-ai",
-        "timestamp": datetime.now().isoformat(),
-        "services": {
-            "supabase_client": supabase_client is not None,
-            "transaction_agent": transaction_agent is not None,
-            "reminder_agent": reminder_agent is not None,
-            "main_agent": main_agent is not None
-        }
-    }
+    global _HEALTH_CACHE
+    now = time.monotonic()
+    if now - _HEALTH_CACHE[0] > 1.0 or not _HEALTH_CACHE[1]:
+        _HEALTH_CACHE = (now, _build_health_body())
+    return Response(content=_HEALTH_CACHE[1], media_type="application/json")
 
 
 ##### HELPER FUNCTIONS #####
@@ -596,14 +748,14 @@ async def check_authentication(request: AuthCheckRequest) -> Dict[str, Any]:
     lang_code = request.language
     try:
         # First, check if the telegram_id is linked to a supabase user
-        user_data = await supabase_client.get_user_by_telegram_id_auth(request.telegram_id)
+        user_data = await cached_get_user(request.telegram_id)
         if user_data:
-            print(f"🔍 Found linked user for telegram_id {request.telegram_id}")
+            logger.info(f"🔍 Found linked user for telegram_id {request.telegram_id}")
             return await _validate_and_complete_user_data(user_data, request.telegram_id)
 
         # If not found, try to link if supabase_user_id is provided
         if request.supabase_user_id:
-            print("Trying to link:", request)
+            logger.debug("Trying to link: %s", request)
             try:
                 result = await supabase_client.link_telegram_user(
                     request.supabase_user_id, 
@@ -611,7 +763,8 @@ async def check_authentication(request: AuthCheckRequest) -> Dict[str, Any]:
                 )
                 if result.get("success"):
                     # After successful link, fetch the complete user data again
-                    user_data = await supabase_client.get_user_by_telegram_id_auth(request.telegram_id)
+                    invalidate_cached_user(request.telegram_id)
+                    user_data = await cached_get_user(request.telegram_id)
                     if user_data:
                         return await _validate_and_complete_user_data(user_data, request.telegram_id)
                 
@@ -619,21 +772,53 @@ async def check_authentication(request: AuthCheckRequest) -> Dict[str, Any]:
                 raise HTTPException(status_code=401, detail=get_message("link_failed", lang_code))
 
             except Exception as e:
-                print(f"❌ Error linking user in check_authentication: {e}")
+                logger.error(f"❌ Error linking user in check_authentication: {e}")
                 raise HTTPException(status_code=401, detail=get_message("link_failed", lang_code))
         
         # If no user found and no supabase_user_id to link, they must register
         else:
-            print(f"⚠️ User {request.telegram_id} not registered.")
+            logger.warning(f"⚠️ User {request.telegram_id} not registered.")
             raise HTTPException(status_code=401, detail=get_message("user_not_registered", lang_code))
 
     except HTTPException:
         raise # Re-raise known HTTP exceptions
     except Exception as e:
-        print(f"❌ Uncaught error in check_authentication: {e}")
+        logger.error(f"❌ Uncaught error in check_authentication: {e}")
         raise HTTPException(status_code=500, detail="An error occurred during authentication.")
 
 
+# Short-TTL cache of Supabase user lookups by telegram_id, plus in-flight lookups
+# so concurrent misses for the same user share a single round-trip
+_user_lookup_cache = TTLCache(maxsize=10_000, ttl=30)
+_user_lookups_inflight: Dict[str, "asyncio.Future[Optional[Dict[str, Any]]]"] = {}
+
+
+async def cached_get_user(telegram_id: str) -> Optional[Dict[str, Any]]:
+    """get_user_by_telegram_id_auth with a 30s per-user cache and miss coalescing."""
+    cached = _user_lookup_cache.get(telegram_id)
+    if cached is not None:
+        return dict(cached)
+
+    lookup = _user_lookups_inflight.get(telegram_id)
+    if lookup is None:
+        lookup = asyncio.ensure_future(supabase_client.get_user_by_telegram_id_auth(telegram_id))
+        _user_lookups_inflight[telegram_id] = lookup
+        lookup.add_done_callback(lambda _: _user_lookups_inflight.pop(telegram_id, None))
+
+    user_data = await asyncio.shield(lookup)
+    if not user_data:
+        return None
+    # Only fully authenticated lookups are cached; fallbacks are retried next time
+    if user_data.get('authenticated'):
+        _user_lookup_cache.set(telegram_id, user_data)
+    return dict(user_data)
+
+
+def invalidate_cached_user(telegram_id: str) -> None:
+    """Drop a cached user lookup after registration, linking or a plan change."""
+    _user_lookup_cache.pop(telegram_id)
+
+
 # Wrap the session manager access and use the exception-based check_authentication
 async def get_user_data(auth_request: AuthCheckRequest) -> Dict[str, Any]:
     """
@@ -641,63 +826,323 @@ async def get_user_data(auth_request: AuthCheckRequest) -> Dict[str, Any]:
     Handles authentication and session creation.
     """
     try:
-        # 1. Check for a valid and complete session first
-        if session_manager.is_authenticated(auth_request.telegram_id):
-            session = session_manager.get_session(auth_request.telegram_id)
-            if session and _is_user_data_complete(session):
-                print(f"✅ Retrieved complete user data from session for {auth_request.telegram_id}")
-                return session
+        # 1. Check for a valid session first (single TTL-checked lookup). Only complete,
+        # authenticated user data is ever stored, so a hit needs no re-validation
+        session = await session_manager.get_session(auth_request.telegram_id)
+        if session:
+            logger.info(f"✅ Retrieved complete user data from session for {auth_request.telegram_id}")
+            return session
         
         # 2. If no valid session, perform full authentication
-        print(f"🔍 No valid session for {auth_request.telegram_id} - performing full authentication.")
+        logger.info(f"🔍 No valid session for {auth_request.telegram_id} - performing full authentication.")
         user_data = await check_authentication(auth_request)
         
-        # 3. On successful authentication, create a new session
-        session_manager.create_session(auth_request.telegram_id, user_data)
-        print(f"✅ Session created for {auth_request.telegram_id}")
+        # 3. On successful authentication, create a new session (complete data only -
+        # incomplete data is re-authenticated next time so it can be completed)
+        if _is_user_data_complete(user_data):
+            await session_manager.create_session(auth_request.telegram_id, user_data)
+            logger.info(f"✅ Session created for {auth_request.telegram_id}")
         
         return user_data
 
     except HTTPException as e:
         # Log and re-raise HTTP exceptions from check_authentication
-        print(f"❌ Authentication failed for {auth_request.telegram_id}: {e.detail}")
+        logger.error(f"❌ Authentication failed for {auth_request.telegram_id}: {e.detail}")
         raise
     except Exception as e:
         # Catch any other unexpected errors
-        print(f"❌ Unexpected error in get_user_data: {e}")
+        logger.error(f"❌ Unexpected error in get_user_data: {e}")
         raise HTTPException(status_code=500, detail="Internal server error during data retrieval.")
 
 
+async def _get_registered_user_data(telegram_id: str) -> Optional[Dict[str, Any]]:
+    """Return user data if the telegram_id is already registered, None if not found."""
+    try:
+        return await get_user_data(AuthCheckRequest.model_construct(telegram_id=telegram_id))
+    except HTTPException as e:
+        # Only continue registration if user not found (401 or 404)
+        if e.status_code not in (401, 404):
+            raise  # Re-raise other errors (service unavailable, etc.)
+        return None
+
+
 # Helper function to validate and complete user data
 async def _validate_and_complete_user_data(user_data: Dict[str, Any], telegram_id: str) -> Dict[str, Any]:
     """Validate user data completeness and fill in missing fields if possible"""
-    required_fields = ['user_id', 'email', 'name', 'authenticated']
-    
-    # Check if all required fields are present and non-empty
-    for field in required_fields:
-        if not user_data.get(field):
-            print(f"⚠️ Missing or empty field '{field}' in user data for {telegram_id} - attempting to complete")
-            # Try to fetch from Supabase Auth if user_id is available
-            if user_data.get('user_id'):
-                try:
-                    auth_user = await supabase_client.supabase.auth.admin.get_user_by_id(user_data['user_id'])
-                    if auth_user.user:
-                        user_data['email'] = auth_user.user.email or user_data.get('email', '')
-                        user_data['name'] = auth_user.user.user_metadata.get('name', user_data.get('name', 'Unknown'))
-                        #user_data['last_name'] = auth_user.user.user_metadata.get('last_name', user_data.get('last_name', ''))
-                        user_data['authenticated'] = True
-                        print(f"✅ Completed user data for {telegram_id}")
-                except Exception as e:
-                    print(f"❌ Failed to complete user data for {telegram_id}: {e}")
-            break  # Stop after first missing field to avoid redundant calls
-    
+    # Complete data (the normal case) never touches the Supabase Auth admin API
+    if _is_user_data_complete(user_data) or not user_data.get('user_id'):
+        return user_data
+
+    logger.warning(f"⚠️ Incomplete user data for {telegram_id} - attempting to complete")
+    try:
+        # Shared with any concurrent lookup of the same user and run off the event loop
+        auth_user = await supabase_client.get_auth_user(user_data['user_id'])
+        if auth_user.user:
+            user_data['email'] = auth_user.user.email or user_data.get('email', '')
+            user_data['name'] = auth_user.user.user_metadata.get('name', user_data.get('name', 'Unknown'))
+            #user_data['last_name'] = auth_user.user.user_metadata.get('last_name', user_data.get('last_name', ''))
+            user_data['authenticated'] = True
+            logger.info(f"✅ Completed user data for {telegram_id}")
+    except Exception as e:
+        logger.error(f"❌ Failed to complete user data for {telegram_id}: {e}")
+
     return user_data
 
+# Fields that must be present and non-empty for user data to count as complete
+_REQUIRED_USER_FIELDS = frozenset({'user_id', 'email', 'name', 'authenticated'})
+
+
 # Helper function to check if user data is complete
 def _is_user_data_complete(user_data: Dict[str, Any]) -> bool:
     """Check if user data has all required fields"""
-    required_fields = ['user_id', 'email', 'name', 'authenticated']
-    return all(user_data.get(field) for field in required_fields)
+    # issubset rejects missing keys in C before any value is inspected
+    return _REQUIRED_USER_FIELDS.issubset(user_data) and all(user_data[field] for field in _REQUIRED_USER_FIELDS)
+
+
+async def _stage_upload(file: UploadFile, suffix: str) -> Tuple[Optional[bytes], Optional[str]]:
+    """
+    Read an upload in chunks. Returns (bytes, None) when it fits in IN_MEMORY_UPLOAD_BYTES,
+    otherwise spills to a temp file and returns (None, path). Rejects files over MAX_UPLOAD_BYTES.
+    """
+    # Reject oversized uploads up front when the client declared a size
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Uploaded file is too large.")
+
+    buffer = bytearray()
+    temp_file = None
+    total = 0
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            total += len(chunk)
+            if total > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="Uploaded file is too large.")
+            if temp_file is None and total > IN_MEMORY_UPLOAD_BYTES:
+                # Disk writes run in a worker thread so the event loop never blocks on them
+                temp_file = await asyncio.to_thread(tempfile.NamedTemporaryFile, delete=False, suffix=suffix)
+                await asyncio.to_thread(temp_file.write, buffer)
+                buffer = bytearray()
+            if temp_file is not None:
+                await asyncio.to_thread(temp_file.write, chunk)
+            else:
+                buffer += chunk
+    except BaseException:
+        if temp_file is not None:
+            await asyncio.to_thread(_discard_temp_file, temp_file)
+        raise
+
+    if temp_file is None:
+        return bytes(buffer), None
+    await asyncio.to_thread(temp_file.close)
+    return None, temp_file.name
+
+
+async def _process_upload(
+    agent: "AgentSlot",
+    file: UploadFile,
+    suffix: str,
+    background_tasks: BackgroundTasks,
+    bytes_call: Callable[..., Awaitable[str]],
+    path_call: Callable[..., Awaitable[str]],
+    *args
+) -> str:
+    """Stage an upload and run the matching agent call (bytes or temp-file path) on it."""
+    data, temp_path = await _stage_upload(file, suffix)
+    if temp_path is None:
+        return await agent.run(bytes_call, *args, data)
+
+    try:
+        result = await agent.run(path_call, *args, temp_path)
+    except BaseException:
+        # Background tasks don't run for error responses - clean up now
+        await asyncio.to_thread(_remove_temp_file, temp_path)
+        raise
+
+    # Clean up temp file after the response has been sent
+    background_tasks.add_task(_remove_temp_file, temp_path)
+    return result
+
+
+def _remove_temp_file(path: str) -> None:
+    """Delete a temp file, ignoring files that are already gone."""
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _discard_temp_file(temp_file) -> None:
+    """Close and delete a partially written temp file."""
+    temp_file.close()
+    _remove_temp_file(temp_file.name)
+
+
+# Per-user agent locks; entries disappear once no request holds a reference
+_user_agent_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _user_agent_lock(user_id: str) -> asyncio.Lock:
+    """Return the lock serialising agent calls for one user."""
+    lock = _user_agent_locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _user_agent_locks[user_id] = lock
+    return lock
+
+
+class AgentSlot:
+    """One reserved agent slot (see agent_slot); run() executes agent calls under it."""
+
+    def __init__(self):
+        self.held = True
+        # Set when a call was abandoned (timeout / disconnect) but is still running
+        self.detached: Optional[asyncio.Future] = None
+
+    async def run(self, agent_call: Callable[..., Awaitable[Any]], *args) -> Any:
+        """Run an agent coroutine, raising 504 if it exceeds AGENT_TIMEOUT_SECONDS."""
+        task = asyncio.ensure_future(agent_call(*args))
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout=AGENT_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.error(f"❌ Agent call {getattr(agent_call, '__name__', agent_call)} timed out after {AGENT_TIMEOUT_SECONDS}s")
+            raise HTTPException(status_code=504, detail="Processing timed out. Please try again.")
+        finally:
+            if not task.done():
+                # Agents do their blocking work in asyncio.to_thread, which can't be cancelled.
+                # Hand the slot over to the abandoned call so AGENT_CONCURRENCY keeps bounding
+                # the worker threads that are really still running
+                self.held = False
+                self.detached = task
+                _detached_agent_tasks.add(task)
+                task.add_done_callback(_release_detached_agent_task)
+
+
+# Timed-out / abandoned agent calls that still occupy a slot until their thread finishes
+_detached_agent_tasks: "set[asyncio.Future]" = set()
+
+
+def _release_detached_agent_task(task: asyncio.Future) -> None:
+    _detached_agent_tasks.discard(task)
+    AGENT_SEM.release()
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"❌ Abandoned agent call failed: {task.exception()}")
+
+
+@asynccontextmanager
+async def agent_slot():
+    """
+    Reserve one of AGENT_CONCURRENCY agent slots. Raises 503 (with Retry-After) if none
+    frees up quickly - take it before charging credits so rejected requests cost nothing.
+    """
+    try:
+        await asyncio.wait_for(AGENT_SEM.acquire(), timeout=0.05)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Server busy, please retry shortly.", headers={"Retry-After": "2"})
+
+    slot = AgentSlot()
+    try:
+        yield slot
+    finally:
+        if slot.held:
+            AGENT_SEM.release()
+
+
+@asynccontextmanager
+async def refund_on_failure(user_data: Dict[str, Any], credit_result: Dict[str, Any], agent: AgentSlot):
+    """
+    Give back the credits charged for an operation only if its work never completed:
+    the upload was rejected or the agent call raised. A call abandoned on timeout or
+    disconnect keeps running, so it is refunded later only if it ends up failing.
+    """
+    try:
+        yield
+    except BaseException:
+        if credit_result.get('credits_used'):
+            task = agent.detached
+            if task is None:
+                # Shielded: the refund must land even when the request is being cancelled
+                await asyncio.shield(_start_refund(user_data, credit_result))
+            else:
+                task.add_done_callback(
+                    lambda done: _refund_if_failed(done, user_data, credit_result)
+                )
+        raise
+
+
+# Refunds still running, kept referenced until they finish
+_pending_refunds: "set[asyncio.Task]" = set()
+
+
+def _start_refund(user_data: Dict[str, Any], credit_result: Dict[str, Any]) -> asyncio.Task:
+    task = asyncio.ensure_future(_refund_credits(user_data, credit_result))
+    _pending_refunds.add(task)
+    task.add_done_callback(_pending_refunds.discard)
+    return task
+
+
+def _refund_if_failed(task: asyncio.Future, user_data: Dict[str, Any], credit_result: Dict[str, Any]) -> None:
+    """Done-callback for an abandoned agent call: refund only if it did not complete."""
+    if task.cancelled() or task.exception() is not None:
+        _start_refund(user_data, credit_result)
+
+
+async def _refund_credits(user_data: Dict[str, Any], credit_result: Dict[str, Any]) -> None:
+    credits_used = credit_result['credits_used']
+    user_id = user_data.get('user_id')
+    try:
+        await supabase_client.refund_credits(user_id, credit_result.get('operation_type', 'unknown'), credits_used)
+        # Let the next /profile read re-read the balance
+        await _update_session_status(user_data, status_refreshed_at=0)
+    except Exception as e:
+        logger.error(f"❌ Failed to refund {credits_used} credits to {user_id}: {e}")
+
+
+async def _update_session_status(user_data: Dict[str, Any], **fields: Any) -> None:
+    """Write premium/credit fields into the user's session (and the caller's copy of it)."""
+    user_data.update(fields)
+    telegram_id = user_data.get('telegram_id')
+    if not telegram_id:
+        return
+    try:
+        await session_manager.update_session(telegram_id, fields)
+    except Exception as e:
+        # The session copy just goes stale until its status slice expires
+        logger.error(f"❌ Could not update session status for {telegram_id}: {e}")
+
+
+async def _refresh_session_status(telegram_id: str, user_data: Dict[str, Any]) -> None:
+    """Re-read premium/credit state into the session; keeps the cached values on DB errors."""
+    try:
+        status = await supabase_client.get_user_status(user_data.get('user_id'))
+    except Exception as e:
+        logger.error(f"❌ Could not refresh status for {telegram_id}: {e}")
+        return
+    if status:
+        user_data.setdefault('telegram_id', telegram_id)
+        await _update_session_status(
+            user_data,
+            is_premium=status['is_premium'],
+            premium_until=status['premium_until'],
+            freemium_credits=status['credits'],
+            status_refreshed_at=time.time(),
+        )
+
+
+@lru_cache(maxsize=256)
+def _credit_suffix(lang: str, credits_remaining: int, low_warning: bool = True) -> str:
+    """Credits-remaining footer appended to non-premium responses, memoized per (lang, value)."""
+    suffix = get_message("credit_warning", lang, credits_remaining=credits_remaining)
+    if low_warning and credits_remaining <= 1:
+        suffix += get_message("credit_low", lang)
+    return suffix
+
+
+@lru_cache(maxsize=64)
+def _insufficient_credits_result(lang: str) -> Dict[str, Any]:
+    """Failure result for an out-of-credit charge, shared per language - callers must not mutate it."""
+    return {
+        "success": False,
+        "message": get_message("insufficient_credits", lang)
+    }
 
 
 async def check_and_consume_credits(user_id: str, operation_type: str, credits_needed: int, user_data: Dict[str, Any] = None) -> dict:
@@ -710,73 +1155,117 @@ async def check_and_consume_credits(user_id: str, operation_type: str, credits_n
     if not user_data:
         raise HTTPException(status_code=401, detail="User data not provided - authentication required")
     
-    # Try to consume credits
-    result = await supabase_client.consume_credits(
+    # Try to consume credits - shielded so a client disconnect can't cancel the call
+    # halfway (the DB debit would commit while the status cache stayed stale)
+    result = await asyncio.shield(supabase_client.consume_credits(
         user_id, operation_type, credits_needed
-    )
+    ))
     
     if not result['success']:
         if result.get('error') == 'insufficient_credits':
-            credits_available = result.get('credits_available', 0)
-            credits_needed = result.get('credits_needed', 0)
-            
-            error_msg = MESSAGES["insufficient_credits"].format(
-                credits_available=credits_available,
-                credits_needed=credits_needed
-            )
-            return {
-                "success": False,
-                "message": error_msg
-            }
+            return _insufficient_credits_result(user_data.get('language', 'en'))
+    elif not result.get('is_premium', False):
+        # Keep the session's balance in step with the debit instead of re-reading it
+        await _update_session_status(
+            user_data,
+            is_premium=False,
+            freemium_credits=result.get('credits_remaining', 0),
+            status_refreshed_at=time.time(),
+        )
     
     return result
 
 
+# Currency per IANA timezone, derived from the tz database's country zones;
+# the explicit entries below take precedence
+_TZ_CURRENCY: Mapping[str, str] = MappingProxyType({
+    **build_timezone_currency_map(),
+    "America/Sao_Paulo": "BRL",
+    "America/New_York": "USD",
+    "America/Los_Angeles": "USD",
+    "Europe/London": "GBP",
+    "Europe/Madrid": "EUR",
+    "Europe/Paris": "EUR",
+    "Europe/Berlin": "EUR",
+    "Asia/Tokyo": "JPY",
+    "Asia/Shanghai": "CNY",
+    "Asia/Kolkata": "INR",
+    "Australia/Sydney": "AUD",
+    "Africa/Johannesburg": "ZAR",
+    "UTC": "USD",  # Default fallback
+})
+
+# Continent fallback when the exact timezone isn't mapped
+_CONTINENT_CURRENCY: Mapping[str, str] = MappingProxyType({
+    "America": "USD",
+    "Europe": "EUR",
+    "Asia": "USD",  # Could be improved with more granular mapping
+    "Australia": "AUD",
+    "Africa": "USD",  # Could be improved
+})
+
+
+@lru_cache(maxsize=512)
 def infer_currency(timezone: str) -> str:
     """Infer currency code from timezone (basic mapping, can be expanded)."""
-    # Simple mapping for common timezones
-    timezone_currency_map = {
-        "America/Sao_Paulo": "BRL",
-        "America/New_York": "USD",
-        "America/Los_Angeles": "USD",
-        "Europe/London": "GBP",
-        "Europe/Madrid": "EUR",
-        "Europe/Paris": "EUR",
-        "Europe/Berlin": "EUR",
-        "Asia/Tokyo": "JPY",
-        "Asia/Shanghai": "CNY",
-        "Asia/Kolkata": "INR",
-        "Australia/Sydney": "AUD",
-        "Africa/Johannesburg": "ZAR",
-        "UTC": "USD",  # Default fallback
-    }
     # Try exact match
-    currency = timezone_currency_map.get(timezone)
+    currency = _TZ_CURRENCY.get(timezone)
     if currency:
         return currency
-    # Fallback: infer from continent
-    if timezone.startswith("America/"):
-        return "USD"
-    elif timezone.startswith("Europe/"):
-        return "EUR"
-    elif timezone.startswith("Asia/"):
-        return "USD"  # Could be improved with more granular mapping
-    elif timezone.startswith("Australia/"):
-        return "AUD"
-    elif timezone.startswith("Africa/"):
-        return "USD"  # Could be improved
+    # Fallback: infer from continent (the area before the first "/")
+    continent, sep, _ = timezone.partition("/")
+    if sep:
+        return _CONTINENT_CURRENCY.get(continent, "USD")
     return "USD"  # Default fallback
 
 
 
+def get_api_workers() -> int:
+    """
+    Number of uvicorn worker processes (UVICORN_WORKERS env). Sessions and user caches
+    are per process unless REDIS_URL is set, and a payment webhook only reaches one
+    worker, so without Redis this is capped at 1; with it, it defaults to the CPU count.
+    """
+    if os.getenv("REDIS_URL"):
+        return int(os.getenv("UVICORN_WORKERS", os.cpu_count() or 1))
+    workers = int(os.getenv("UVICORN_WORKERS", 1))
+    if workers > 1:
+        logger.warning(
+            f"⚠️ UVICORN_WORKERS={workers} needs REDIS_URL for shared sessions - running 1 worker"
+        )
+    return 1
+
+
+def get_uvicorn_options() -> Dict[str, Any]:
+    """Production uvicorn settings shared by api.run_api and main.run_api."""
+    return {
+        "host": "0.0.0.0",
+        "port": int(os.getenv("PORT", 8000)),
+        "workers": get_api_workers(),
+        # uvloop has no Windows build
+        "loop": "asyncio" if sys.platform == "win32" else "uvloop",
+        "http": "httptools",
+        "limit_concurrency": int(os.getenv("UVICORN_LIMIT_CONCURRENCY", 1000)),
+        "timeout_keep_alive": 30
+    }
+
+
 def run_api():
-    """Run the API server"""
-    uvicorn.run(
-        "api:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True
-    )
+    """
+    Run the API server.
+    Dev:  ENV=dev python api.py   (single process + file watcher)
+    Prod: gunicorn -k uvicorn.workers.UvicornWorker -w $(( $(nproc)*2 + 1 )) -b 0.0.0.0:8000 --preload api:app
+          (more than one worker only with REDIS_URL set - see get_api_workers)
+    """
+    # Imported here so ASGI servers that import api:app don't load uvicorn for nothing
+    import uvicorn
+
+    options = get_uvicorn_options()
+    reload = os.getenv("ENV") == "dev"
+    if reload:
+        # reload and multiple workers are mutually exclusive in uvicorn
+        options["workers"] = 1
+    uvicorn.run("api:app", reload=reload, **options)
 
 if __name__ == "__main__":
     run_api()
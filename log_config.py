@@ -0,0 +1,60 @@
+import logging
+import logging.handlers
+import os
+import queue
+from typing import Optional
+
+# Listener draining queued log records on a background thread, and the handler feeding it
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[logging.handlers.QueueHandler] = None
+# Process that started _listener; threads don't survive fork, so a forked worker
+# (e.g. gunicorn --preload) must start its own
+_listener_pid: Optional[int] = None
+
+
+def setup_logging(level: Optional[str] = None) -> None:
+    """
+    Route all logging through a QueueHandler so request handlers never block on stdout.
+    A QueueListener thread does the actual (blocking) writes. Safe to call more than once,
+    and again after fork: the child drops the inherited handler and starts its own listener.
+    """
+    global _listener, _queue_handler, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        return
+    if _queue_handler is not None:
+        # Inherited from the parent process - its listener thread doesn't exist here
+        logging.getLogger().removeHandler(_queue_handler)
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s")
+    )
+
+    root = logging.getLogger()
+    root.setLevel(level or os.getenv("LOG_LEVEL", "INFO"))
+    _queue_handler = logging.handlers.QueueHandler(log_queue)
+    root.addHandler(_queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    if _listener_pid is None and hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_restart_after_fork)
+    _listener_pid = os.getpid()
+
+
+def _restart_after_fork() -> None:
+    if _queue_handler is not None:
+        setup_logging()
+
+
+def shutdown_logging() -> None:
+    """Flush queued records and stop the listener thread"""
+    global _listener, _queue_handler, _listener_pid
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        if _listener_pid == os.getpid():
+            _listener.stop()
+        _listener = None
@@ -14,17 +14,17 @@ sys.path.insert(0, str(Path(__file__).parent))
 def run_api():
     """Run the API service using uvicorn"""
     import uvicorn
-    from api import app
+    from api import get_uvicorn_options
     
     print("🔧 Starting API service...")
     
     # Use uvicorn.run() directly - this will create its own event loop
+    # Pass the import string so uvicorn can spawn one process per worker
     uvicorn.run(
-        app,
-        host="0.0.0.0",
-        port=8000,
+        "api:app",
         reload=False,
-        log_level="info"
+        log_level="info",
+        **get_uvicorn_options()
     )
 
 async def run_bot():
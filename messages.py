@@ -1,3 +1,7 @@
+from functools import lru_cache
+from string import Formatter
+from typing import Callable, Dict
+
 MESSAGES = {
     "en": {
         "welcome_authenticated": (
@@ -261,12 +265,45 @@ Just talk to me naturally - I understand! 🎉
 }
 
 
+# --- Precompiled message formatters ---
+# Templates are parsed once at import: static messages become constant strings and
+# templated ones keep a bound str.format, so get_message is a single dict lookup per call.
+_MESSAGE_NOT_FOUND = "Message key not found."
+
+
+def _compile_template(template: str) -> Callable[..., str]:
+    """Return a formatter callable for a message template."""
+    has_fields = any(field is not None for _, field, _, _ in Formatter().parse(template))
+    if not has_fields:
+        literal = template.format()  # resolves escaped braces once
+        return lambda **_: literal
+    return template.format
+
+
+_COMPILED_EN: Dict[str, Callable[..., str]] = {
+    key: _compile_template(template) for key, template in MESSAGES["en"].items()
+}
+
+# Each language falls back to English per key
+COMPILED_MESSAGES: Dict[str, Dict[str, Callable[..., str]]] = {
+    lang: {**_COMPILED_EN, **{key: _compile_template(template) for key, template in messages.items()}}
+    for lang, messages in MESSAGES.items()
+}
+
+
+def _message_not_found(**_) -> str:
+    return _MESSAGE_NOT_FOUND
+
+
+@lru_cache(maxsize=64)
+def _messages_for(lang: str) -> Dict[str, Callable[..., str]]:
+    """Resolve a raw language code (e.g. 'pt-BR') to its compiled message table."""
+    lang_short = lang.split('-')[0] if lang else 'en'
+    # Fallback to 'en' if language is not found
+    return COMPILED_MESSAGES.get(lang_short, _COMPILED_EN)
+
+
 def get_message(key: str, lang: str, **kwargs) -> str:
     """Gets a translated message, falling back to English."""
-    lang_short = lang.split('-')[0] if lang else 'en'
-    
-    # Fallback to 'en' if language or key is not found
-    messages = MESSAGES.get(lang_short, MESSAGES['en'])
-    message_template = messages.get(key, MESSAGES['en'].get(key, "Message key not found."))
-    
-    return message_template.format(**kwargs)
\ No newline at end of file
+    # Fallback to 'en' if key is not found (tables are already merged over English)
+    return _messages_for(lang).get(key, _message_not_found)(**kwargs)
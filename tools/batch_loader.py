@@ -0,0 +1,80 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set
+
+
+class BatchLoader:
+    """
+    DataLoader-style coalescer: keys requested within a short window are fetched
+    with one batch call instead of one round-trip each.
+
+    batch_fn receives a list of unique keys and returns a {key: value} mapping;
+    keys missing from the mapping resolve to None.
+
+    When no batch is in flight, keys are dispatched on the next loop iteration
+    (coalescing only what was requested in the same tick); batch_window adds a
+    wait while an earlier batch is still running.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]],
+        max_batch_size: int = 100,
+        batch_window: float = 0.0
+    ):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        self._flush_handle: Optional[asyncio.Handle] = None
+        # Strong references to in-flight dispatches, so they can't be garbage collected
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def load(self, key: Hashable) -> Any:
+        """Queue a key for the next batch and wait for its value"""
+        future = self._pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending[key] = future
+
+            if len(self._pending) >= self.max_batch_size:
+                self._flush()
+            elif self._flush_handle is None:
+                if self._tasks and self.batch_window > 0:
+                    self._flush_handle = loop.call_later(self.batch_window, self._flush)
+                else:
+                    self._flush_handle = loop.call_soon(self._flush)
+
+        return await asyncio.shield(future)
+
+    def _flush(self) -> None:
+        """Dispatch everything queued so far as one batch"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, {}
+        if batch:
+            task = asyncio.ensure_future(self._dispatch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, batch: Dict[Hashable, asyncio.Future]) -> None:
+        try:
+            results = await self.batch_fn(list(batch))
+        except asyncio.CancelledError:
+            # Shutdown / loop teardown: release every waiter instead of leaving load() hanging
+            for future in batch.values():
+                future.cancel()
+            raise
+        except BaseException as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(results.get(key))
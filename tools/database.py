@@ -1,5 +1,6 @@
 # Simple database manager with RLS policies
 import asyncpg
+import logging
 from typing import List, Optional, Dict, Any, Tuple
 from datetime import datetime, timedelta
 from decimal import Decimal
@@ -10,6 +11,8 @@ from .models import (
     UserActivity, ReminderType, Priority, TransactionType, UserSettings
 )
 
+logger = logging.getLogger(__name__)
+
 class Database:
     """Simplified Database manager with RLS policies"""
     
@@ -17,16 +20,22 @@ class Database:
         self.database_url = database_url
         self.pool = None
     
-    async def connect(self):
-        """Initialize database connection"""
-        self.pool = await asyncpg.create_pool(self.database_url)
-        print("✅ Database connected")
+    async def connect(self, min_size: int = 1, max_size: int = 10):
+        """Initialize database connection pool (bounded per process)"""
+        self.pool = await asyncpg.create_pool(
+            self.database_url,
+            min_size=min_size,
+            max_size=max_size,
+            # Recycle idle connections so a quiet worker gives them back to Postgres
+            max_inactive_connection_lifetime=300
+        )
+        logger.info("✅ Database connected")
 
     async def close(self):
         """Close database connection"""
         if self.pool:
             await self.pool.close()
-            print("✅ Database disconnected")
+            logger.info("✅ Database disconnected")
     
     async def _create_tables(self):
         """Create simplified tables with RLS policies and proper permissions"""
@@ -204,6 +213,25 @@ class Database:
                 COMMENT ON COLUMN payments.valid_until IS 'Premium access valid until this date';
             """)
             
+            # 5. Credit usage ledger (one row per debit or refund of freemium credits)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS credit_usage (
+                    id BIGSERIAL PRIMARY KEY,
+                    user_id UUID NOT NULL,
+                    operation_type TEXT NOT NULL,
+                    credits_delta INTEGER NOT NULL,
+                    activity_data JSONB DEFAULT '{}' NOT NULL,
+                    created_at TIMESTAMPTZ DEFAULT NOW() NOT NULL
+                );
+                
+                -- Indexes for credit_usage
+                CREATE INDEX IF NOT EXISTS idx_credit_usage_user_id ON credit_usage(user_id, created_at);
+                
+                -- Table comments
+                COMMENT ON TABLE credit_usage IS 'Freemium credit debits and compensating refunds';
+                COMMENT ON COLUMN credit_usage.credits_delta IS 'Negative for credits consumed, positive for refunds';
+            """)
+            
             # ============================================================================
             # ENABLE ROW LEVEL SECURITY ON ALL TABLES
             # ============================================================================
@@ -212,6 +240,7 @@ class Database:
                 ALTER TABLE reminders ENABLE ROW LEVEL SECURITY;
                 ALTER TABLE user_settings ENABLE ROW LEVEL SECURITY;
                 ALTER TABLE payments ENABLE ROW LEVEL SECURITY;
+                ALTER TABLE credit_usage ENABLE ROW LEVEL SECURITY;
             """)
             
             # ============================================================================
@@ -287,6 +316,16 @@ class Database:
                     FOR UPDATE USING ((SELECT auth.uid()) = user_id);
             """)
             
+            # ============================================================================
+            # CREATE RLS POLICIES FOR CREDIT_USAGE (written only by the credit functions)
+            # ============================================================================
+            await conn.execute("""
+                DROP POLICY IF EXISTS "Users can view own credit usage" ON credit_usage;
+                
+                CREATE POLICY "Users can view own credit usage" ON credit_usage
+                    FOR SELECT USING ((SELECT auth.uid()) = user_id);
+            """)
+            
             # Create automatic timestamp triggers
             await conn.execute("""
                 DROP TRIGGER IF EXISTS update_transactions_updated_at ON transactions;
@@ -430,6 +469,7 @@ class Database:
                         RETURN jsonb_build_object(
                             'success', true,
                             'is_premium', true,
+                            'operation_type', p_operation_type,
                             'credits_used', 0,
                             'credits_remaining', -1,
                             'message', 'Premium user - unlimited usage'
@@ -447,7 +487,7 @@ class Database:
                         );
                     END IF;
                     
-                    -- Consume credits (only update user_settings)
+                    -- Consume credits and record the debit in the ledger
                     credits_after := current_credits - p_credits_needed;
                     
                     UPDATE user_settings 
@@ -455,9 +495,15 @@ class Database:
                         updated_at = NOW()
                     WHERE user_id = p_user_id;
                     
+                    IF p_credits_needed > 0 THEN
+                        INSERT INTO credit_usage (user_id, operation_type, credits_delta, activity_data)
+                        VALUES (p_user_id, p_operation_type, -p_credits_needed, COALESCE(p_activity_data, '{}'));
+                    END IF;
+                    
                     RETURN jsonb_build_object(
                         'success', true,
                         'is_premium', false,
+                        'operation_type', p_operation_type,
                         'credits_used', p_credits_needed,
                         'credits_remaining', credits_after,
                         'message', 'Credits consumed successfully'
@@ -466,6 +512,59 @@ class Database:
                 $$;
             """)
             
+            # Give back credits for an operation whose work never completed, with a
+            # compensating ledger row so credit_usage keeps matching the balance
+            await conn.execute("""
+                CREATE OR REPLACE FUNCTION refund_freemium_credits(
+                    p_user_id UUID,
+                    p_operation_type TEXT,
+                    p_credits INTEGER,
+                    p_activity_data JSONB DEFAULT '{}'
+                )
+                RETURNS JSONB 
+                LANGUAGE plpgsql
+                SECURITY DEFINER
+                SET search_path = public
+                AS $$
+                DECLARE
+                    credits_after INTEGER;
+                BEGIN
+                    IF p_credits <= 0 THEN
+                        RETURN jsonb_build_object(
+                            'success', false,
+                            'error', 'invalid_amount',
+                            'message', 'Refund amount must be positive'
+                        );
+                    END IF;
+                    
+                    UPDATE user_settings
+                    SET freemium_credits = freemium_credits + p_credits,
+                        updated_at = NOW()
+                    WHERE user_id = p_user_id
+                    RETURNING freemium_credits INTO credits_after;
+                    
+                    IF NOT FOUND THEN
+                        RETURN jsonb_build_object(
+                            'success', false,
+                            'error', 'user_not_found',
+                            'message', 'User not found'
+                        );
+                    END IF;
+                    
+                    INSERT INTO credit_usage (user_id, operation_type, credits_delta, activity_data)
+                    VALUES (p_user_id, p_operation_type, p_credits,
+                            COALESCE(p_activity_data, '{}') || jsonb_build_object('refund', true));
+                    
+                    RETURN jsonb_build_object(
+                        'success', true,
+                        'credits_refunded', p_credits,
+                        'credits_remaining', credits_after,
+                        'message', 'Credits refunded successfully'
+                    );
+                END;
+                $$;
+            """)
+            
             # ✅ GRANT PROPER PERMISSIONS TO SUPABASE ROLES
             await conn.execute("""
                 -- Grant full table access to Supabase roles
@@ -477,6 +576,7 @@ class Database:
                 GRANT ALL PRIVILEGES ON TABLE reminders TO anon;
                 GRANT ALL PRIVILEGES ON TABLE payments TO authenticated;
                 GRANT ALL PRIVILEGES ON TABLE payments TO anon;
+                GRANT SELECT ON TABLE credit_usage TO authenticated;
                 
                 -- Grant sequence permissions for auto-increment IDs
                 GRANT USAGE, SELECT ON ALL SEQUENCES IN SCHEMA public TO authenticated;
@@ -493,6 +593,8 @@ class Database:
                 GRANT EXECUTE ON FUNCTION reset_monthly_credits() TO anon;
                 GRANT EXECUTE ON FUNCTION consume_freemium_credits(UUID, TEXT, INTEGER, JSONB) TO authenticated;
                 GRANT EXECUTE ON FUNCTION consume_freemium_credits(UUID, TEXT, INTEGER, JSONB) TO anon;
+                -- Refunds are server-side only: never callable through the public RPC roles
+                REVOKE EXECUTE ON FUNCTION refund_freemium_credits(UUID, TEXT, INTEGER, JSONB) FROM PUBLIC, authenticated, anon;
                 
                 -- Set default privileges for future objects
                 ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT ALL ON TABLES TO authenticated;
@@ -503,7 +605,7 @@ class Database:
                 ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT EXECUTE ON FUNCTIONS TO anon;
             """)
             
-            print("✅ Database tables created with RLS policies, security fixes, and proper Supabase permissions")
+            logger.info("✅ Database tables created with RLS policies, security fixes, and proper Supabase permissions")
     
     # ============================================================================
     # TRANSACTION OPERATIONS (Expenses + Income)
@@ -777,7 +879,7 @@ class Database:
             """, user_id, provider, amount, currency, valid_until)
             
             payment_id = str(result['id'])
-            print(f"✅ Created payment record {payment_id} for user {user_id}")
+            logger.info(f"✅ Created payment record {payment_id} for user {user_id}")
             return payment_id
 
     async def update_payment_status(self, payment_id: str, status: str, transaction_id: str = None, subscription_id: str = None):
@@ -798,7 +900,7 @@ class Database:
                 raise ValueError(f"Payment {payment_id} not found")
             
             user_id = str(result['user_id'])
-            print(f"✅ Updated payment {payment_id} status to {status}")
+            logger.info(f"✅ Updated payment {payment_id} status to {status}")
 
     async def get_payment_by_id(self, payment_id: str) -> Optional[Dict[str, Any]]:
         """Get payment details by ID"""
@@ -1,67 +1,173 @@
+import logging
 import asyncio
-from typing import Dict, Optional, Any
+import heapq
+import time
+from typing import Dict, List, Optional, Any, Set, Tuple
 from datetime import datetime, timedelta
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# Datetime fields are stored as ISO 8601 strings by both managers, so sessions (and the
+# /profile bodies and ETags built from them) look the same in memory and in Redis
+_DATETIME_FIELDS = ('premium_until', 'last_activity')
+
+
+def _normalize_datetimes(fields: Dict[str, Any]) -> Dict[str, Any]:
+    for key in _DATETIME_FIELDS:
+        value = fields.get(key)
+        if isinstance(value, datetime):
+            fields[key] = value.isoformat()
+    return fields
 
 class SessionManager:
     """In-memory session manager for user authentication"""
-    
+
     def __init__(self, session_timeout_minutes: int = 30):
         self.sessions: Dict[str, Dict[str, Any]] = {}
         self.session_timeout = timedelta(minutes=session_timeout_minutes)
-        
+        self._timeout_seconds = self.session_timeout.total_seconds()
+
+        # Monotonic deadline per session plus a min-heap of (deadline, telegram_id),
+        # so expiry only touches sessions that are actually due instead of scanning all
+        self._expires_at: Dict[str, float] = {}
+        self._expiry_heap: List[Tuple[float, str]] = []
+        # Ids with an entry in the heap (at most one each, even across invalidate/create)
+        self._scheduled: Set[str] = set()
+
         # Start cleanup task
-        asyncio.create_task(self._cleanup_expired_sessions())
-    
-    def create_session(self, telegram_id: str, user_data: Dict[str, Any]) -> None:
+        self._cleanup_task = asyncio.create_task(self._cleanup_expired_sessions())
+
+    async def create_session(self, telegram_id: str, user_data: Dict[str, Any]) -> None:
         """Create or update user session"""
-        self.sessions[telegram_id] = {
+        self.sessions[telegram_id] = _normalize_datetimes({
             **user_data,
             'last_activity': datetime.now(),
             'authenticated': True
-        }
-    
-    def get_session(self, telegram_id: str) -> Optional[Dict[str, Any]]:
+        })
+        deadline = time.monotonic() + self._timeout_seconds
+        if telegram_id not in self._scheduled:
+            heapq.heappush(self._expiry_heap, (deadline, telegram_id))
+            self._scheduled.add(telegram_id)
+        self._expires_at[telegram_id] = deadline
+
+    async def get_session(self, telegram_id: str) -> Optional[Dict[str, Any]]:
         """Get user session if valid"""
+        now = time.monotonic()
+        self._expire_due(now)
+
         session = self.sessions.get(telegram_id)
         if not session:
             return None
-        
-        # Check if session expired
-        if datetime.now() - session['last_activity'] > self.session_timeout:
-            self.sessions.pop(telegram_id, None)
-            return None
-        
-        # Update last activity
-        session['last_activity'] = datetime.now()
+
+        # Sliding expiration: the heap entry is refreshed lazily when it comes due
+        self._expires_at[telegram_id] = now + self._timeout_seconds
+        session['last_activity'] = datetime.now().isoformat()
         return session
-    
-    def is_authenticated(self, telegram_id: str) -> bool:
+
+    async def update_session(self, telegram_id: str, fields: Dict[str, Any]) -> None:
+        """Merge fields into an existing session without touching its expiry (no-op if absent)"""
+        session = self.sessions.get(telegram_id)
+        if session is not None:
+            session.update(_normalize_datetimes(dict(fields)))
+
+    async def is_authenticated(self, telegram_id: str) -> bool:
         """Check if user is authenticated"""
-        session = self.get_session(telegram_id)
+        session = await self.get_session(telegram_id)
         return session is not None and session.get('authenticated', False)
-    
-    def invalidate_session(self, telegram_id: str) -> None:
+
+    async def invalidate_session(self, telegram_id: str) -> None:
         """Remove user session"""
         self.sessions.pop(telegram_id, None)
-    
+        self._expires_at.pop(telegram_id, None)
+
+    async def close(self) -> None:
+        """Stop the cleanup task"""
+        self._cleanup_task.cancel()
+
+    def _expire_due(self, now: float) -> int:
+        """Pop heap entries whose deadline has passed; returns the number of sessions removed"""
+        removed = 0
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            _, telegram_id = heapq.heappop(heap)
+            deadline = self._expires_at.get(telegram_id)
+            if deadline is None:
+                self._scheduled.discard(telegram_id)
+                continue  # Already invalidated
+            if deadline > now:
+                # Session was touched since this entry was pushed - reschedule it
+                heapq.heappush(heap, (deadline, telegram_id))
+                continue
+            self.sessions.pop(telegram_id, None)
+            del self._expires_at[telegram_id]
+            self._scheduled.discard(telegram_id)
+            removed += 1
+        return removed
+
     async def _cleanup_expired_sessions(self) -> None:
         """Cleanup expired sessions periodically"""
         while True:
             try:
-                now = datetime.now()
-                expired_sessions = [
-                    telegram_id for telegram_id, session in self.sessions.items()
-                    if now - session['last_activity'] > self.session_timeout
-                ]
-                
-                for telegram_id in expired_sessions:
-                    self.sessions.pop(telegram_id, None)
-                
-                if expired_sessions:
-                    print(f"🧹 Cleaned up {len(expired_sessions)} expired sessions")
-                
+                removed = self._expire_due(time.monotonic())
+
+                if removed:
+                    logger.info(f"🧹 Cleaned up {removed} expired sessions")
+
                 # Run cleanup every 5 minutes
                 await asyncio.sleep(300)
             except Exception as e:
-                print(f"❌ Error in session cleanup: {e}")
-                await asyncio.sleep(300)
\ No newline at end of file
+                logger.error(f"❌ Error in session cleanup: {e}")
+                await asyncio.sleep(300)
+
+
+class RedisSessionManager:
+    """Redis-backed session manager shared by all API workers (same interface as SessionManager)"""
+
+    KEY_PREFIX = "sess:"
+
+    def __init__(self, redis_url: str, session_timeout_minutes: int = 30, max_connections: int = 50):
+        # Optional dependency - only needed when REDIS_URL is configured
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(redis_url, max_connections=max_connections)
+        self.session_timeout = timedelta(minutes=session_timeout_minutes)
+        self._timeout_seconds = int(self.session_timeout.total_seconds())
+
+    async def create_session(self, telegram_id: str, user_data: Dict[str, Any]) -> None:
+        """Create or update user session"""
+        session = _normalize_datetimes({
+            **user_data,
+            'last_activity': datetime.now(),
+            'authenticated': True
+        })
+        await self.redis.set(self.KEY_PREFIX + telegram_id, orjson.dumps(session), ex=self._timeout_seconds)
+
+    async def get_session(self, telegram_id: str) -> Optional[Dict[str, Any]]:
+        """Get user session if valid (GETEX also slides the expiry in the same round-trip)"""
+        raw = await self.redis.getex(self.KEY_PREFIX + telegram_id, ex=self._timeout_seconds)
+        if not raw:
+            return None
+        return orjson.loads(raw)
+
+    async def update_session(self, telegram_id: str, fields: Dict[str, Any]) -> None:
+        """Merge fields into an existing session, keeping its TTL (no-op if absent)"""
+        key = self.KEY_PREFIX + telegram_id
+        raw = await self.redis.get(key)
+        if not raw:
+            return
+        session = {**orjson.loads(raw), **_normalize_datetimes(dict(fields))}
+        await self.redis.set(key, orjson.dumps(session), keepttl=True, xx=True)
+
+    async def is_authenticated(self, telegram_id: str) -> bool:
+        """Check if user is authenticated"""
+        session = await self.get_session(telegram_id)
+        return session is not None and session.get('authenticated', False)
+
+    async def invalidate_session(self, telegram_id: str) -> None:
+        """Remove user session"""
+        await self.redis.delete(self.KEY_PREFIX + telegram_id)
+
+    async def close(self) -> None:
+        """Close the Redis connection pool"""
+        await self.redis.aclose()
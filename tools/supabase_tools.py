@@ -1,5 +1,8 @@
+import logging
 from typing import Dict, Any, List, Optional, Tuple
 from .database import Database
+from .ttl_cache import TTLCache
+from .batch_loader import BatchLoader
 from .models import Transaction, Reminder, TransactionType, ReminderType, Priority, UserSettings
 from datetime import datetime, timedelta
 import os
@@ -7,15 +10,62 @@ from supabase import create_client, Client
 from supabase.lib.client_options import ClientOptions
 from gotrue.errors import AuthApiError
 import json
+import asyncio
+import httpx
 import stripe
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Precomputed PayPal renewal link; only the payment id varies per call
+_PAYPAL_TMPL = "https://www.paypal.com/cgi-bin/webscr?cmd=_s-xclick&hosted_button_id=YOUR_BUTTON_ID&custom={}"
+
+
+@lru_cache(maxsize=None)
+def _get_config(name: str, default: Optional[str] = None) -> Optional[str]:
+    """Read a config value from the environment once per process."""
+    return os.getenv(name, default)
+
+
+@lru_cache(maxsize=1)
+def _stripe_redirect_urls() -> Tuple[str, str]:
+    """Stripe Checkout success/cancel URLs pointing back to the Telegram bot."""
+    bot_username = _get_config("TELEGRAM_BOT_USERNAME", "")
+    return (
+        f"https://t.me/{bot_username}?start=payment_success",
+        f"https://t.me/{bot_username}?start=payment_cancelled"
+    )
+
+
+def _create_http_client() -> httpx.Client:
+    """Pooled HTTP client for the Supabase SDK; uses HTTP/2 when the h2 package is installed."""
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+
+    return httpx.Client(
+        http2=http2,
+        timeout=httpx.Timeout(10.0),
+        # Keep idle connections for 30s (httpx default is 5s) so sparse traffic still reuses TLS sessions
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=30.0)
+    )
+
 
 class SupabaseClient:
     """Supabase client for direct database operations"""
     
-    def __init__(self, supabase_url: str, supabase_key: str):
+    def __init__(self, supabase_url: str, supabase_key: str, http_client: Optional[httpx.Client] = None):
         self.supabase_url = supabase_url
         self.supabase_key = supabase_key
-        self.supabase: Client = create_client(supabase_url, supabase_key)
+
+        # One pooled keep-alive HTTP client for every Supabase SDK call in this process
+        self._owns_http_client = http_client is None
+        self.http_client = http_client or _create_http_client()
+        self.supabase: Client = create_client(
+            supabase_url, supabase_key, options=ClientOptions(httpx_client=self.http_client)
+        )
 
         stripe.api_key = os.getenv("STRIPE_API_KEY")
 
@@ -26,20 +76,39 @@ class SupabaseClient:
         
         self.database = Database(database_url)
         self.connected = False
+
+        # Short-lived cache of premium/credit state (rarely changes within seconds)
+        self._status_cache = TTLCache(maxsize=5000, ttl=5)
+
+        # Concurrent user_settings lookups by telegram_id are batched into one query
+        self._user_row_loader = BatchLoader(self._fetch_user_rows_by_telegram_ids)
+
+        # In-flight Supabase Auth lookups, so concurrent calls for the same user share one request
+        self._auth_lookups_inflight: Dict[str, asyncio.Future] = {}
+    
+    def invalidate_user_status(self, user_id: str) -> None:
+        """Drop cached premium/credit status for a user after it changes"""
+        self._status_cache.pop(user_id)
     
     async def connect(self):
         """Connect to the database"""
         if not self.connected:
-            await self.database.connect()
+            # Per-process pool bounds - keep workers x DB_POOL_MAX_SIZE below Postgres max_connections
+            await self.database.connect(
+                min_size=int(_get_config("DB_POOL_MIN_SIZE", "1")),
+                max_size=int(_get_config("DB_POOL_MAX_SIZE", "10"))
+            )
             self.connected = True
-            print("✅ Database connected successfully")
+            logger.info("✅ Database connected successfully")
     
     async def disconnect(self):
         """Disconnect from the database"""
         if self.connected:
             await self.database.close()
             self.connected = False
-            print("✅ Database disconnected")
+            logger.info("✅ Database disconnected")
+        if self._owns_http_client and not self.http_client.is_closed:
+            self.http_client.close()
 
     async def ensure_user_exists(self, telegram_id: str, user_data: dict):
         """
@@ -104,7 +173,7 @@ class SupabaseClient:
                     else:
                         # Subscription expired: create payment and generate PayPal renewal link
                         payment_id = await self.database.create_payment(user_id, "paypal", 9.99, currency)
-                        paypal_url = f"https://www.paypal.com/cgi-bin/webscr?cmd=_s-xclick&hosted_button_id=YOUR_BUTTON_ID&custom={payment_id}"
+                        paypal_url = _PAYPAL_TMPL.format(payment_id)
                         
                         return {
                             "success": False,
@@ -128,7 +197,7 @@ class SupabaseClient:
                             "paypal_url": paypal_url
                         }
         except Exception as e:
-            print(f"❌ Error ensuring user exists: {e}")
+            logger.error(f"❌ Error ensuring user exists: {e}")
             return {"success": False, "message": "❌ Internal error. Please try again later."}
 
     #adjust this function to also get the user name and insert it into the database
@@ -137,7 +206,7 @@ class SupabaseClient:
         try:
             if not self.connected:
                 await self.connect()
-            print(f"Linking Telegram {telegram_id} to Supabase {supabase_user_id}")
+            logger.debug(f"Linking Telegram {telegram_id} to Supabase {supabase_user_id}")
 
             async with self.database.pool.acquire() as conn:
                 await conn.execute("""
@@ -150,7 +219,7 @@ class SupabaseClient:
                 """, supabase_user_id, telegram_id)
             return {"success": True, "message": f"✅ Linked Telegram user {telegram_id} to Supabase user {supabase_user_id}"}
         except Exception as e:
-            print(f"❌ Error linking Telegram user: {e}")
+            logger.error(f"❌ Error linking Telegram user: {e}")
             raise
     
     async def get_user_by_telegram_id(self, telegram_id: str) -> str:
@@ -167,36 +236,54 @@ class SupabaseClient:
                 return str(result['user_id']) if result else None
                 
         except Exception as e:
-            print(f"❌ Error getting user by telegram ID: {e}")
+            logger.error(f"❌ Error getting user by telegram ID: {e}")
             return None
     
+    async def get_user_status(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Premium and credit state for a user in one query (short-TTL cached)"""
+        cached = self._status_cache.get(user_id)
+        if cached is not None:
+            return cached
+
+        if not self.connected:
+            await self.connect()
+
+        async with self.database.pool.acquire() as conn:
+            row = await conn.fetchrow("""
+                SELECT is_premium, premium_until, freemium_credits, credits_reset_date
+                FROM user_settings 
+                WHERE user_id = $1
+            """, user_id)
+
+        if not row:
+            return None
+
+        # Check if premium is active and not expired
+        is_premium = row['is_premium']
+        premium_until = row['premium_until']
+        if is_premium and premium_until:
+            premium_active = datetime.now() < premium_until.replace(tzinfo=None)
+        else:
+            premium_active = bool(is_premium)
+
+        status = {
+            "is_premium": is_premium,
+            "premium_active": premium_active,
+            "premium_until": premium_until,
+            "credits": row['freemium_credits'],
+            "credits_reset_date": row['credits_reset_date']
+        }
+        self._status_cache.set(user_id, status)
+        return status
+
     async def check_premium_status(self, user_id: str) -> bool:
         """Check if user has premium access"""
         try:
-            if not self.connected:
-                await self.connect()
-                
-            async with self.database.pool.acquire() as conn:
-                result = await conn.fetchrow("""
-                    SELECT is_premium, premium_until 
-                    FROM user_settings 
-                    WHERE user_id = $1
-                """, user_id)
-                
-                if result:
-                    # Check if premium is active and not expired
-                    is_premium = result['is_premium']
-                    premium_until = result['premium_until']
-                    
-                    if is_premium and premium_until:
-                        return datetime.now() < premium_until.replace(tzinfo=None)
-                    
-                    return is_premium
-                
-                return False
+            status = await self.get_user_status(user_id)
+            return status["premium_active"] if status else False
                 
         except Exception as e:
-            print(f"❌ Error checking premium status: {e}")
+            logger.error(f"❌ Error checking premium status: {e}")
             return False
 
     # Payment-related methods
@@ -214,7 +301,7 @@ class SupabaseClient:
         
         # Update payment status
         await self.database.update_payment_status(payment_id, "success", transaction_id, subscription_id)
-        print(f"✅ Payment {payment_id} processed successfully")
+        logger.info(f"✅ Payment {payment_id} processed successfully")
 
     async def process_payment_failure(self, payment_id: str, reason: str = "failed"):
         """Process failed payment"""
@@ -222,7 +309,7 @@ class SupabaseClient:
             await self.connect()
         
         await self.database.update_payment_status(payment_id, reason)
-        print(f"❌ Payment {payment_id} failed: {reason}")
+        logger.error(f"❌ Payment {payment_id} failed: {reason}")
 
     async def get_user_payment_history(self, user_id: str) -> List[Dict[str, Any]]:
         """Get user payment history"""
@@ -250,13 +337,12 @@ class SupabaseClient:
                 return {"success": False, "message": "Failed to create payment record."}
 
             # 2. Create a Stripe Checkout Session
-            price_id = os.getenv("STRIPE_PRICE_ID")
-            bot_username = os.getenv("TELEGRAM_BOT_USERNAME", "")
-            print("bot_username", bot_username)
-            success_url = f"https://t.me/{bot_username}?start=payment_success"
-            cancel_url = f"https://t.me/{bot_username}?start=payment_cancelled"
+            price_id = _get_config("STRIPE_PRICE_ID")
+            success_url, cancel_url = _stripe_redirect_urls()
 
-            checkout_session = stripe.checkout.Session.create(
+            # stripe-python is synchronous - keep the API round-trip off the event loop
+            checkout_session = await asyncio.to_thread(
+                stripe.checkout.Session.create,
                 line_items=[{'price': price_id, 'quantity': 1}],
                 mode='subscription',
                 success_url=success_url,
@@ -271,16 +357,16 @@ class SupabaseClient:
                 "stripe_url": checkout_session.url # Return the Stripe URL
             }
         except Exception as e:
-            print(f"❌ Error creating Stripe upgrade link: {e}")
+            logger.error(f"❌ Error creating Stripe upgrade link: {e}")
             return {"success": False, "message": str(e)}
 
 
     
     async def handle_stripe_webhook(self, payload: bytes, sig_header: str) -> Tuple[bool, Optional[str]]:
         """Handle Stripe payment webhook"""
-        webhook_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
+        webhook_secret = _get_config("STRIPE_WEBHOOK_SECRET")
         if not webhook_secret:
-            print("❌ Stripe webhook secret is not configured.")
+            logger.error("❌ Stripe webhook secret is not configured.")
             return False, None
 
         try:
@@ -289,11 +375,11 @@ class SupabaseClient:
             )
         except ValueError as e:
             # Invalid payload
-            print(f"❌ Invalid webhook payload: {e}")
+            logger.error(f"❌ Invalid webhook payload: {e}")
             return False, None
         except stripe.error.SignatureVerificationError as e:
             # Invalid signature
-            print(f"❌ Invalid webhook signature: {e}")
+            logger.error(f"❌ Invalid webhook signature: {e}")
             return False, None
 
         # Handle the checkout.session.completed event
@@ -306,10 +392,10 @@ class SupabaseClient:
             customer_id = session.get('customer') # Stripe customer ID
 
             if not payment_id:
-                print("❌ Webhook received without a client_reference_id (payment_id).")
+                logger.error("❌ Webhook received without a client_reference_id (payment_id).")
                 return False, None
 
-            print(f"✅ checkout.session.completed for payment_id: {payment_id}")
+            logger.info(f"✅ checkout.session.completed for payment_id: {payment_id}")
             
             # Update our database
             await self.process_payment_success(payment_id, customer_id, subscription_id)
@@ -317,6 +403,7 @@ class SupabaseClient:
             # Find the payment record and get the user_id, then fetch telegram_id
             payment_record = await self.database.get_payment_by_id(payment_id)
             user_id = payment_record.get("user_id")
+            self.invalidate_user_status(user_id)
             user_settings = await self.database.get_user_settings_by_user_id(user_id)
             telegram_id = user_settings.get("telegram_id")
             
@@ -324,7 +411,7 @@ class SupabaseClient:
             return True, telegram_id
             
         else:
-            print(f"ℹ️ Received unhandled Stripe event type: {event['type']}")
+            logger.info(f"ℹ️ Received unhandled Stripe event type: {event['type']}")
             return True, None # Return True to acknowledge receipt of the event
         return False, None
     
@@ -336,7 +423,8 @@ class SupabaseClient:
                 import secrets
                 password = secrets.token_urlsafe(16)
             
-            response = self.supabase.auth.sign_up({
+            # The SDK call is synchronous - keep the GoTrue round-trip off the event loop
+            response = await asyncio.to_thread(self.supabase.auth.sign_up, {
                 "email": email,
                 "display_name": user_metadata.get("name") if user_metadata else None,
                 "password": password,
@@ -390,7 +478,7 @@ class SupabaseClient:
             return None
             
         except Exception as e:
-            print(f"❌ Error getting user by email: {e}")
+            logger.error(f"❌ Error getting user by email: {e}")
             return None
 
     async def link_telegram_to_auth_user(self, auth_user_id: str, telegram_id: str, telegram_data: Dict[str, Any]) -> bool:
@@ -411,65 +499,81 @@ class SupabaseClient:
             return True
             
         except Exception as e:
-            print(f"❌ Error linking Telegram to auth user: {e}")
+            logger.error(f"❌ Error linking Telegram to auth user: {e}")
             return False
 
+    async def _fetch_user_rows_by_telegram_ids(self, telegram_ids: List[str]) -> Dict[str, Any]:
+        """Batch function for the user row loader: one query for many telegram_ids"""
+        async with self.database.pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT telegram_id, user_id, currency, name, language, timezone, is_premium, premium_until, freemium_credits
+                FROM user_settings
+                WHERE telegram_id = ANY($1::text[])
+            """, telegram_ids)
+        return {row['telegram_id']: row for row in rows}
+
+    async def get_auth_user(self, user_id: str):
+        """Supabase Auth admin get_user_by_id, run off the event loop and shared by concurrent callers"""
+        lookup = self._auth_lookups_inflight.get(user_id)
+        if lookup is None:
+            lookup = asyncio.ensure_future(
+                asyncio.to_thread(self.supabase.auth.admin.get_user_by_id, user_id)
+            )
+            self._auth_lookups_inflight[user_id] = lookup
+            lookup.add_done_callback(lambda _: self._auth_lookups_inflight.pop(user_id, None))
+        return await asyncio.shield(lookup)
+
     async def get_user_by_telegram_id_auth(self, telegram_id: str) -> Optional[Dict[str, Any]]:
         """Get user info by Telegram ID using auth system"""
         try:
-            async with self.database.pool.acquire() as conn:
-                # Get user_id from user_settings
-                user_row = await conn.fetchrow("""
-                    SELECT user_id, currency, name, language, timezone, is_premium, premium_until, freemium_credits
-                    FROM user_settings
-                    WHERE telegram_id = $1
-                """, telegram_id)
+            # Get user_id from user_settings (batched with concurrent lookups)
+            user_row = await self._user_row_loader.load(telegram_id)
                 
-                if not user_row:
-                    return None
+            if not user_row:
+                return None
                 
-                # Get auth user data
-                auth_user_id = str(user_row['user_id'])
+            # Get auth user data
+            auth_user_id = str(user_row['user_id'])
                 
-                try:
-                    # Get user from Supabase Auth
-                    auth_response = self.supabase.auth.admin.get_user_by_id(auth_user_id)
+            try:
+                # Get user from Supabase Auth
+                auth_response = await self.get_auth_user(auth_user_id)
                     
-                    if auth_response.user:
-                        return {
-                            'user_id': auth_user_id,
-                            'email': auth_response.user.email,
-                            'name': auth_response.user.user_metadata.get('name'),
-                            'currency': user_row['currency'],
-                            'language': user_row['language'],
-                            'timezone': user_row['timezone'],
-                            'is_premium': user_row['is_premium'],
-                            'premium_until': user_row['premium_until'],
-                            'freemium_credits': user_row['freemium_credits'],
-                            'telegram_id': telegram_id,
-                            'authenticated': True
-                        }
-                except Exception as auth_error:
-                    print(f"❌ Error getting auth user: {auth_error}")
-                    # Fallback: return basic data from user_settings
+                if auth_response.user:
                     return {
                         'user_id': auth_user_id,
-                        'email': None,
-                        'name': None,
+                        'email': auth_response.user.email,
+                        'name': auth_response.user.user_metadata.get('name'),
                         'currency': user_row['currency'],
                         'language': user_row['language'],
                         'timezone': user_row['timezone'],
                         'is_premium': user_row['is_premium'],
                         'premium_until': user_row['premium_until'],
-                        'freemium_credits': 0,
+                        'freemium_credits': user_row['freemium_credits'],
                         'telegram_id': telegram_id,
-                        'authenticated': False  # Not authenticated if can't get auth data
+                        'authenticated': True
                     }
+            except Exception as auth_error:
+                logger.error(f"❌ Error getting auth user: {auth_error}")
+                # Fallback: return basic data from user_settings
+                return {
+                    'user_id': auth_user_id,
+                    'email': None,
+                    'name': None,
+                    'currency': user_row['currency'],
+                    'language': user_row['language'],
+                    'timezone': user_row['timezone'],
+                    'is_premium': user_row['is_premium'],
+                    'premium_until': user_row['premium_until'],
+                    'freemium_credits': 0,
+                    'telegram_id': telegram_id,
+                    'authenticated': False  # Not authenticated if can't get auth data
+                }
                 
-                return None
+            return None
                 
         except Exception as e:
-            print(f"❌ Error getting user by telegram ID: {e}")
+            logger.error(f"❌ Error getting user by telegram ID: {e}")
             return None
 
     async def create_new_user_settings(self, auth_user_id: str, user_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
@@ -485,7 +589,7 @@ class SupabaseClient:
            await self.database.save_user_settings(new_user_data)
            return {'success': True, 'user_data': new_user_data}
         except Exception as e:
-            print(f"❌ Error creating new user settings: {e}")
+            logger.error(f"❌ Error creating new user settings: {e}")
             raise
 
     # Update ensure_user_exists method to work with auth
@@ -552,7 +656,7 @@ class SupabaseClient:
                 payment_id = await self.database.create_payment(
                     user_info['user_id'], "paypal", 9.99, user_info.get('currency', 'USD')
                 )
-                paypal_url = f"https://www.paypal.com/cgi-bin/webscr?cmd=_s-xclick&hosted_button_id=YOUR_BUTTON_ID&custom={payment_id}"
+                paypal_url = _PAYPAL_TMPL.format(payment_id)
                 
                 return {
                     "success": False,
@@ -570,7 +674,7 @@ class SupabaseClient:
                 }
                 
         except Exception as e:
-            print(f"❌ Error ensuring user exists: {e}")
+            logger.error(f"❌ Error ensuring user exists: {e}")
             return {"success": False, "message": "❌ Internal error. Please try again later."}
 
 
@@ -580,7 +684,7 @@ class SupabaseClient:
         """Check if user exists in Supabase Auth by user ID"""
         try:
             # Attempt to get user by ID from Supabase Auth
-            auth_response = self.supabase.auth.admin.get_user_by_id(supabase_user_id)
+            auth_response = await self.get_auth_user(supabase_user_id)
             
             if auth_response.user:
                 return True
@@ -588,7 +692,7 @@ class SupabaseClient:
                 return False
             
         except Exception as e:
-            print(f"❌ Error checking user by base ID: {e}")
+            logger.error(f"❌ Error checking user by base ID: {e}")
             return False
 
     async def consume_credits(self, user_id: str, operation_type: str, credits_needed: int, activity_data: dict = None) -> dict:
@@ -598,29 +702,32 @@ class SupabaseClient:
                 SELECT consume_freemium_credits($1, $2, $3, $4) as result
             """, user_id, operation_type, credits_needed, json.dumps(activity_data or {}))
             
-            return json.loads(result['result'])
+        # Balance (and possibly premium state) just changed
+        self.invalidate_user_status(user_id)
+        return json.loads(result['result'])
+    
+    async def refund_credits(self, user_id: str, operation_type: str, credits: int, activity_data: dict = None) -> dict:
+        """Give back credits consumed for an operation that did not complete (logged in credit_usage)"""
+        async with self.database.pool.acquire() as conn:
+            result = await conn.fetchrow("""
+                SELECT refund_freemium_credits($1, $2, $3, $4) as result
+            """, user_id, operation_type, credits, json.dumps(activity_data or {}))
+
+        self.invalidate_user_status(user_id)
+        return json.loads(result['result'])
     
     async def get_user_credits(self, user_id: str) -> dict:
         """Get user's current credit status"""
-        if not self.connected:
-            await self.connect()
+        status = await self.get_user_status(user_id)
+        if not status:
+            return {"credits": 0, "is_premium": False, "error": "User not found"}
         
-        async with self.database.pool.acquire() as conn:
-            row = await conn.fetchrow("""
-                SELECT freemium_credits, is_premium, credits_reset_date, premium_until
-                FROM user_settings 
-                WHERE user_id = $1
-            """, user_id)
-            
-            if not row:
-                return {"credits": 0, "is_premium": False, "error": "User not found"}
-            
-            return {
-                "credits": row['freemium_credits'],
-                "is_premium": row['is_premium'],
-                "credits_reset_date": row['credits_reset_date'],
-                "premium_until": row['premium_until']
-            }
+        return {
+            "credits": status['credits'],
+            "is_premium": status['is_premium'],
+            "credits_reset_date": status['credits_reset_date'],
+            "premium_until": status['premium_until']
+        }
 
     async def reset_monthly_credits(self) -> int:
         """Reset monthly credits for all eligible users"""
@@ -629,7 +736,9 @@ class SupabaseClient:
         
         async with self.database.pool.acquire() as conn:
             result = await conn.fetchval("SELECT reset_monthly_credits()")
-            return result
+        
+        self._status_cache.clear()
+        return result
 
     async def ensure_user_exists(self, user_id: str, user_data: dict = None):
         """Ensure user exists in user_settings table"""
@@ -658,6 +767,6 @@ class SupabaseClient:
                 user_data.get("timezone", "UTC") if user_data else "UTC"
                 )
                 
-                print(f"✅ Created user settings for user ID: {user_id}")
+                logger.info(f"✅ Created user settings for user ID: {user_id}")
             else:
-                print(f"✅ User {user_id} already exists")
\ No newline at end of file
+                logger.info(f"✅ User {user_id} already exists")
\ No newline at end of file